@@ -0,0 +1,166 @@
+"""Compare the accuracy and cost of buffer shapes used to sample points.
+
+Without ``--gee`` only client side costs are measured: vertex count, area
+and boundary error against a true circle, and the size and time to encode
+the buffer coordinates as JSON. With ``--gee`` each shape, along with
+GEE's own geodesic ``buffer``, is also serialized as a FeatureCollection
+and reduced over ``ee.Image.pixelArea`` to time the request and compare
+the sampled area.
+"""
+import argparse
+import json
+import math
+import random
+import time
+
+import ee
+
+import ee_geometry
+import ee_session
+
+# GEE's own server side buffer, the behaviour before client side shapes
+EE_BUFFER_SHAPE = 'ee-buffer'
+
+
+def _random_points(n_points, seed):
+    """Return ``n_points`` (lon, lat) tuples spread over the continental US."""
+    rng = random.Random(seed)
+    return [
+        (rng.uniform(-124, -67), rng.uniform(25, 49))
+        for _ in range(n_points)]
+
+
+def _shape_accuracy(radius, buffer_shape, max_error):
+    """Return (n vertices, area error %, max boundary error m) of a shape.
+
+    Errors are relative to a true circle of ``radius``, the boundary error
+    is the largest distance between the polygon edge and the circle.
+    """
+    n_vertices, circumradius = ee_geometry.buffer_vertices(
+        radius, buffer_shape, max_error)
+    polygon_area = 0.5 * n_vertices * circumradius**2 * math.sin(
+        2 * math.pi / n_vertices)
+    apothem = circumradius * math.cos(math.pi / n_vertices)
+    area_error = 100 * (polygon_area - math.pi * radius**2) / (
+        math.pi * radius**2)
+    boundary_error = max(circumradius - radius, radius - apothem)
+    return n_vertices, area_error, boundary_error
+
+
+def _time_json(point_list, radius, buffer_shape, max_error):
+    """Return (seconds, bytes) to build and JSON encode every buffer."""
+    start_time = time.time()
+    payload = json.dumps([
+        ee_geometry.buffer_coordinates(
+            lon, lat, radius, buffer_shape, max_error)
+        for lon, lat in point_list])
+    return time.time() - start_time, len(payload)
+
+
+def _ee_features(point_list, radius, buffer_shape, max_error):
+    """Return an ``ee.FeatureCollection`` of buffers of one shape."""
+    if buffer_shape == EE_BUFFER_SHAPE:
+        geometry_list = [
+            ee.Geometry.Point(lon, lat).buffer(radius, max_error)
+            for lon, lat in point_list]
+    else:
+        geometry_list = [
+            ee_geometry.buffer_geometry(
+                lon, lat, radius, buffer_shape, max_error)
+            for lon, lat in point_list]
+    return ee.FeatureCollection([
+        ee.Feature(geometry, {'id': index})
+        for index, geometry in enumerate(geometry_list)])
+
+
+def _time_gee(point_list, radius, buffer_shape, max_error, scale):
+    """Time serializing and reducing buffers of one shape on GEE.
+
+    Returns:
+        (serialize seconds, serialized bytes, reduce seconds, mean sampled
+        area in m^2)
+    """
+    feature_collection = _ee_features(
+        point_list, radius, buffer_shape, max_error)
+    start_time = time.time()
+    serialized = feature_collection.serialize()
+    serialize_time = time.time() - start_time
+
+    start_time = time.time()
+    samples = ee.Image.pixelArea().reduceRegions(**{
+        'collection': feature_collection,
+        'reducer': ee.Reducer.sum(),
+        'scale': scale,
+        }).getInfo()
+    reduce_time = time.time() - start_time
+    area_list = [
+        feature['properties']['sum'] for feature in samples['features']]
+    return (
+        serialize_time, len(serialized), reduce_time,
+        sum(area_list) / len(area_list))
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the accuracy and cost of point buffer shapes.')
+    parser.add_argument('--buffer', type=float, default=1000.0, help='buffer distance in meters, defaults to 1000m')
+    parser.add_argument('--n_points', type=int, default=1000, help='number of random points to buffer, defaults to 1000')
+    parser.add_argument('--buffer_shape', nargs='+', default=['circle', 'polygon:16', 'polygon:8', 'square'], help='shapes to compare, any of circle, square or polygon:N')
+    parser.add_argument('--buffer_max_error', type=float, nargs='+', default=[None], help='one or more maximum errors in meters to compare for circles, defaults to 1%% of the buffer distance')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the points')
+    parser.add_argument('--gee', action='store_true', help='also time serializing and reducing each shape on GEE, against GEE\'s own buffer')
+    parser.add_argument('--scale', type=float, default=30.0, help='scale in meters to reduce at with --gee, defaults to 30m')
+    args = parser.parse_args()
+
+    point_list = _random_points(args.n_points, args.seed)
+    shape_error_list = []
+    for buffer_shape in args.buffer_shape:
+        ee_geometry.parse_buffer_shape(buffer_shape)
+        if buffer_shape == 'circle':
+            shape_error_list.extend(
+                (buffer_shape, max_error)
+                for max_error in args.buffer_max_error)
+        else:
+            shape_error_list.append((buffer_shape, None))
+
+    print(
+        f'{args.n_points} points buffered by {args.buffer:g}m\n'
+        f'{"shape":<12}{"max error":>10}{"vertices":>10}{"area err %":>12}'
+        f'{"edge err m":>12}{"json KB":>10}{"json ms":>10}')
+    for buffer_shape, max_error in shape_error_list:
+        n_vertices, area_error, boundary_error = _shape_accuracy(
+            args.buffer, buffer_shape, max_error)
+        json_time, json_bytes = _time_json(
+            point_list, args.buffer, buffer_shape, max_error)
+        max_error_str = 'default' if max_error is None else f'{max_error:g}'
+        print(
+            f'{buffer_shape:<12}{max_error_str:>10}{n_vertices:>10}'
+            f'{area_error:>12.3f}{boundary_error:>12.2f}'
+            f'{json_bytes/1024:>10.1f}{json_time*1000:>10.1f}')
+
+    if not args.gee:
+        return
+
+    ee_session.get_session()
+    print(
+        f'\nGEE pixelArea reduce at {args.scale:g}m\n'
+        f'{"shape":<12}{"max error":>10}{"payload KB":>12}'
+        f'{"serialize ms":>14}{"reduce s":>10}{"area err %":>12}')
+    baseline_area = None
+    for buffer_shape, max_error in (
+            [(EE_BUFFER_SHAPE, None)] + shape_error_list):
+        serialize_time, serialized_bytes, reduce_time, mean_area = _time_gee(
+            point_list, args.buffer, buffer_shape, max_error, args.scale)
+        if baseline_area is None:
+            baseline_area = mean_area
+        max_error_str = 'default' if max_error is None else f'{max_error:g}'
+        print(
+            f'{buffer_shape:<12}{max_error_str:>10}'
+            f'{serialized_bytes/1024:>12.1f}{serialize_time*1000:>14.1f}'
+            f'{reduce_time:>10.2f}'
+            f'{100*(mean_area-baseline_area)/baseline_area:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Measure how long each entry point takes to start.
+
+Every command is run in a fresh interpreter with ``--help`` so only import
+and argument parsing time is measured, no GEE requests are made.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+COMMAND_LIST = [
+    ['-c', 'pass'],
+    ['ee_cli.py', '--help'],
+    ['ee_cli.py', 'point-sample', '--help'],
+    ['ee_cli.py', 'pheno-sample', '--help'],
+    ['ee_cli.py', 'trace', '--help'],
+    ['ee_point_sampler.py', '--help'],
+    ['ee_sampler.py', '--help'],
+    ['ee_tracer.py', '--help'],
+    # what the lazy imports defer, for comparison
+    ['-c', 'import ee, geopandas, numpy, pandas'],
+]
+
+
+def _time_command(command, n_runs):
+    """Return the wall times in seconds of ``n_runs`` runs of ``command``."""
+    time_list = []
+    for _ in range(n_runs):
+        start_time = time.perf_counter()
+        subprocess.run(
+            [sys.executable] + command, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time_list.append(time.perf_counter() - start_time)
+    return time_list
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the startup time of the sampling entry points.')
+    parser.add_argument('--n_runs', type=int, default=5, help='number of runs of each command, defaults to 5')
+    args = parser.parse_args()
+
+    print(f'{"command":<45}{"min ms":>10}{"median ms":>12}')
+    for command in COMMAND_LIST:
+        time_list = _time_command(command, args.n_runs)
+        print(
+            f'{" ".join(command):<45}{min(time_list)*1000:>10.0f}'
+            f'{statistics.median(time_list)*1000:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Array backed accumulator of sampled values indexed by point."""
+import ee_lazy
+
+numpy = ee_lazy.lazy_import('numpy')
+
+
+class SampleAccumulator(object):
+    """One preallocated float64 column per sampled field.
+
+    Values are written in place into the row of their point as results
+    arrive, so merging a result never copies the samples of other fields
+    or points. Fields that were never sampled for a point stay NaN.
+    """
+
+    def __init__(self, point_index_list):
+        """Allocate rows for every point index in ``point_index_list``."""
+        self.point_index_array = numpy.array(
+            sorted(point_index_list), dtype=numpy.int64)
+        self._row_by_point_index = {
+            point_index: row
+            for row, point_index in enumerate(self.point_index_array.tolist())}
+        self._column_by_key = {}
+        self._sampled = numpy.zeros(
+            self.point_index_array.shape, dtype=bool)
+
+    def _column(self, key):
+        """Return the column for ``key``, allocating it on first use."""
+        column = self._column_by_key.get(key)
+        if column is None:
+            column = numpy.full(self.point_index_array.shape, numpy.nan)
+            self._column_by_key[key] = column
+        return column
+
+    def add_keys(self, key_iter):
+        """Make sure columns exist for every key even if never sampled."""
+        for key in key_iter:
+            self._column(key)
+
+    def mark_sampled(self, point_index_iter):
+        """Write rows for these points even if no result ever covers them."""
+        for point_index in point_index_iter:
+            self._sampled[self._row_by_point_index[point_index]] = True
+
+    def set_values(self, point_index, value_dict):
+        """Write ``value_dict`` of key to value into a point's row.
+
+        None values are left as NaN.
+        """
+        row = self._row_by_point_index[point_index]
+        self._sampled[row] = True
+        for key, value in value_dict.items():
+            column = self._column(key)
+            if value is not None:
+                column[row] = value
+
+    def keys(self):
+        """Return a sorted list of every sampled field."""
+        return sorted(self._column_by_key)
+
+    def iter_rows(self, key_list):
+        """Yield (point index, float64 values of ``key_list``) per point.
+
+        Only points that received at least one result or were marked
+        sampled are yielded, in point index order.
+        """
+        if key_list:
+            value_matrix = numpy.column_stack(
+                [self._column_by_key[key] for key in key_list])
+        else:
+            value_matrix = numpy.empty((self.point_index_array.size, 0))
+        for row in numpy.flatnonzero(self._sampled):
+            yield int(self.point_index_array[row]), value_matrix[row]
+
+
+def format_value(value, invalid_str='invalid'):
+    """Format a float64 sample for a csv, NaN is ``invalid_str``."""
+    if numpy.isnan(value):
+        return invalid_str
+    if value.is_integer():
+        return str(int(value))
+    return repr(float(value))
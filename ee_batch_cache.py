@@ -0,0 +1,70 @@
+"""Persistent cache of the sampled results of whole batches of points."""
+import hashlib
+import json
+import os
+
+
+def batch_key(config, batch_table):
+    """Return a key identifying one batch of a sampling run.
+
+    Args:
+        config (str): everything other than the points that changes the
+            sampled values, like the datasets, buffers, scale and reducers
+        batch_table (pandas.DataFrame): rows of the batch, with the index
+            they are written to the output at
+
+    Returns:
+        hex digest of ``config`` and the batch rows
+    """
+    digest = hashlib.sha256(config.encode('utf-8'))
+    digest.update(batch_table.to_csv().encode('utf-8'))
+    return digest.hexdigest()
+
+
+class BatchCache(object):
+    """Directory of JSON files with the request results of each batch.
+
+    A batch is only stored once all its requests have finished, so an
+    interrupted run is resumed by skipping every batch that is in the
+    cache and sampling the rest.
+    """
+
+    def __init__(self, cache_dir):
+        """Create or open the cache at ``cache_dir``."""
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        """Return the path of the file storing ``key``."""
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        """Look up the request results stored under ``key``.
+
+        Returns:
+            list of (set of property ids, list of properties dicts) tuples,
+            one per request of the batch, or None if ``key`` is not cached
+        """
+        try:
+            with open(self._path(key)) as cache_file:
+                result_list = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        return [
+            (set(sample_key_list), sample_list)
+            for sample_key_list, sample_list in result_list]
+
+    def put(self, key, result_list):
+        """Store the request results of a finished batch under ``key``.
+
+        The file is written next to its final path and moved into place so
+        a run stopped while writing never leaves a partial batch behind.
+        """
+        tmp_path = f'{self._path(key)}.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump([
+                (sorted(sample_key_set), sample_list)
+                for sample_key_set, sample_list in result_list], cache_file,
+                # point table values may be numpy scalars
+                default=lambda value: value.item())
+        os.replace(tmp_path, self._path(key))
@@ -0,0 +1,48 @@
+"""Single entry point for the GEE sampling scripts.
+
+Heavy modules (``ee``, ``numpy``, ``pandas``, ``geopandas``) are imported
+lazily by every script, so ``--help`` and argument errors return without
+loading them and each subcommand only loads what its code path uses.
+"""
+import argparse
+
+import ee_point_sampler
+import ee_sampler
+import ee_shard
+import ee_tracer
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='Sample GEE datasets at the points of a CSV table.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    point_parser = subparsers.add_parser(
+        'point-sample', help='sample MODIS phenology with NLCD/CORINE natural and cultivated fractions at buffered points')
+    ee_point_sampler.add_arguments(point_parser)
+    point_parser.set_defaults(run=ee_point_sampler.run)
+
+    pheno_parser = subparsers.add_parser(
+        'pheno-sample', help='sample MODIS phenology masked by NLCD/CORINE natural and cultivated areas at buffered points')
+    ee_sampler.add_arguments(pheno_parser)
+    pheno_parser.set_defaults(run=ee_sampler.run)
+
+    trace_parser = subparsers.add_parser(
+        'trace', help='extract the full time series of an image collection at points')
+    ee_tracer.add_arguments(trace_parser)
+    trace_parser.set_defaults(run=ee_tracer.run)
+
+    merge_parser = subparsers.add_parser(
+        'merge', help='check all shards are complete and merge them into the final table in original row order')
+    ee_shard.add_arguments(merge_parser)
+    merge_parser.set_defaults(run=ee_shard.run)
+
+    args = parser.parse_args()
+    # configured after parsing so --help and usage errors stay quiet
+    ee_point_sampler.configure_logging()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Landcover datasets used to mask samples into natural/cultivated areas."""
+
+NLCD_ID = 'NLCD'
+CORINE_ID = 'CORINE'
+
+# id lists are inclusive (min, max) ranges of landcover classes
+LANDCOVER_DB = {
+    NLCD_ID: {
+        'asset_id': 'USGS/NLCD_RELEASES/2016_REL',
+        'valid_years': (
+            1992, 2001, 2004, 2006, 2008, 2011, 2013, 2016),
+        'closest_year_field': 'NLCD-year',
+        'natural_field': 'NLCD-natural',
+        'cultivated_field': 'NLCD-cultivated',
+        'natural_id_list': [(41, 74), (90, 95)],
+        'cultivated_id_list': [(81, 82)],
+        'native_scale': 30,
+        },
+    CORINE_ID: {
+        'asset_id': 'COPERNICUS/CORINE/V20/100m',
+        'valid_years': (1990, 2000, 2006, 2012, 2018),
+        'closest_year_field': 'CORINE-year',
+        'natural_field': 'CORINE-natural',
+        'cultivated_field': 'CORINE-cultivated',
+        'natural_id_list': [(311, 423)],
+        'cultivated_id_list': [(211, 244)],
+        'native_scale': 100,
+        },
+}
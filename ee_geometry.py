@@ -0,0 +1,154 @@
+"""Client-side buffer geometries with a bounded number of vertices."""
+import math
+
+import ee_lazy
+
+ee = ee_lazy.lazy_import('ee')
+numpy = ee_lazy.lazy_import('numpy')
+
+METERS_PER_DEGREE = 111319.49
+DEFAULT_BUFFER_SHAPE = 'circle'
+BUFFER_SHAPE_HELP = 'circle, square or polygon:N'
+# GEE's own buffers default to an error of 1% of the buffer distance
+DEFAULT_MAX_ERROR_FRACTION = 0.01
+MIN_VERTICES = 3
+
+
+def parse_buffer_shape(buffer_shape):
+    """Parse a ``circle``, ``square`` or ``polygon:N`` buffer shape.
+
+    Returns:
+        number of vertices of a regular polygon buffer or None for a circle
+        whose vertex count depends on its allowed error
+
+    Raises:
+        ValueError if ``buffer_shape`` is not one of the above.
+    """
+    if buffer_shape == 'circle':
+        return None
+    if buffer_shape == 'square':
+        return 4
+    shape_id, _, n_vertices_str = buffer_shape.partition(':')
+    if shape_id == 'polygon':
+        try:
+            n_vertices = int(n_vertices_str)
+        except ValueError:
+            n_vertices = 0
+        if n_vertices >= MIN_VERTICES:
+            return n_vertices
+    raise ValueError(
+        f'unknown buffer shape "{buffer_shape}", expected '
+        f'{BUFFER_SHAPE_HELP} with N >= {MIN_VERTICES}')
+
+
+def circle_vertex_count(radius, max_error=None):
+    """Return the fewest vertices for a circle within ``max_error`` m.
+
+    The edges of a regular polygon inscribed in a circle fall short of it by
+    at most ``radius * (1 - cos(pi / n))``.
+
+    Args:
+        radius (float): circle radius in m
+        max_error (float): maximum distance in m between the circle and its
+            polygon, defaults to ``DEFAULT_MAX_ERROR_FRACTION`` of ``radius``
+
+    Returns:
+        number of vertices, at least ``MIN_VERTICES``
+    """
+    if max_error is None:
+        max_error = DEFAULT_MAX_ERROR_FRACTION * radius
+    if max_error >= radius:
+        return MIN_VERTICES
+    n_vertices = math.ceil(math.pi / math.acos(1 - max_error / radius))
+    return max(MIN_VERTICES, n_vertices)
+
+
+def _polygon_circumradius(radius, n_vertices):
+    """Return the circumradius of an n-gon with the area of a circle."""
+    return radius * math.sqrt(
+        2 * math.pi / (n_vertices * math.sin(2 * math.pi / n_vertices)))
+
+
+def buffer_vertices(radius, buffer_shape, max_error=None):
+    """Return the (n vertices, circumradius in m) of a buffer shape.
+
+    Circles are inscribed polygons within ``max_error`` of the circle.
+    Squares and ``polygon:N`` shapes are scaled to the area of the circle
+    so landcover fractions and areas stay comparable, ``max_error`` does
+    not apply to them.
+    """
+    n_vertices = parse_buffer_shape(buffer_shape)
+    if n_vertices is None:
+        return circle_vertex_count(radius, max_error), radius
+    return n_vertices, _polygon_circumradius(radius, n_vertices)
+
+
+def buffer_coordinates(lon, lat, radius, buffer_shape, max_error=None):
+    """Build the ring of a buffered point as explicit coordinates.
+
+    Vertices are offset from the point in a local equirectangular
+    approximation, which is accurate for buffers of a few km. The first
+    vertex sits at an angle of pi / n so a square is axis aligned.
+
+    Args:
+        lon (float): longitude of point center in degrees
+        lat (float): latitude of point center in degrees
+        radius (float): buffer distance in m
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N``
+        max_error (float): maximum error in m of a circle, defaults to
+            ``DEFAULT_MAX_ERROR_FRACTION`` of ``radius``
+
+    Returns:
+        closed, counterclockwise list of [lon, lat] vertices
+    """
+    n_vertices, circumradius = buffer_vertices(
+        radius, buffer_shape, max_error)
+    lon_meters = METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)
+    ring = []
+    for vertex_index in range(n_vertices):
+        angle = math.pi * (2 * vertex_index + 1) / n_vertices
+        ring.append([
+            lon + circumradius * math.cos(angle) / lon_meters,
+            lat + circumradius * math.sin(angle) / METERS_PER_DEGREE])
+    ring.append(list(ring[0]))
+    return ring
+
+
+def buffer_geometry(lon, lat, radius, buffer_shape, max_error=None):
+    """Return an ``ee.Geometry.Polygon`` buffer built client side.
+
+    The polygon is planar in EPSG:4326 so GEE only has to serialize and
+    rasterize its few vertices rather than compute a geodesic buffer.
+    """
+    return ee.Geometry.Polygon(
+        [buffer_coordinates(lon, lat, radius, buffer_shape, max_error)],
+        None, False)
+
+
+def inside_buffer(dx, dy, radius, buffer_shape):
+    """Test which offsets in m from a point are inside its buffer shape.
+
+    Circles are tested exactly, polygons by their edge half planes. Edge
+    normals of the polygons built by ``buffer_coordinates`` are at angles
+    of ``2 * pi * k / n``.
+
+    Args:
+        dx (numpy.ndarray): east offsets in m
+        dy (numpy.ndarray): north offsets in m, broadcastable with ``dx``
+        radius (float): buffer distance in m
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N``
+
+    Returns:
+        numpy bool array of the broadcast shape of ``dx`` and ``dy``
+    """
+    n_vertices = parse_buffer_shape(buffer_shape)
+    if n_vertices is None:
+        return (dx**2 + dy**2) <= radius**2
+    apothem = _polygon_circumradius(radius, n_vertices) * math.cos(
+        math.pi / n_vertices)
+    inside = None
+    for edge_index in range(n_vertices):
+        angle = 2 * math.pi * edge_index / n_vertices
+        edge_inside = (dx * math.cos(angle) + dy * math.sin(angle)) <= apothem
+        inside = edge_inside if inside is None else inside & edge_inside
+    return numpy.asarray(inside)
@@ -0,0 +1,30 @@
+"""Defer importing heavy modules until they are first used."""
+import importlib.util
+import sys
+
+
+def lazy_import(module_name):
+    """Return ``module_name`` as a module that is only loaded when used.
+
+    The module is registered in ``sys.modules`` straight away, so later
+    ``import`` statements of it get the same lazy module, but its code only
+    runs on the first attribute access. ``--help`` and other paths that
+    never touch ``ee``, ``numpy``, ``pandas`` or ``geopandas`` skip their
+    import time entirely.
+
+    Raises:
+        ModuleNotFoundError if ``module_name`` is not installed.
+    """
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(module_name)
+    if spec is None:
+        raise ModuleNotFoundError(
+            f'No module named {module_name!r}', name=module_name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    loader.exec_module(module)
+    return module
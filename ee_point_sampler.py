@@ -1,61 +1,58 @@
 """Samples GEE assets using provided CSV point tables."""
 from datetime import datetime
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import csv
 import functools
 import os
 import json
 import logging
 import itertools
 import math
+import time
+
+import ee_accumulator
+import ee_batch_cache
+import ee_datasets
+import ee_geometry
+import ee_lazy
+import ee_reducers
+import ee_session
+import ee_shard
+import ee_site_cache
+import ee_tile_cache
+
+geopandas = ee_lazy.lazy_import('geopandas')
+ee = ee_lazy.lazy_import('ee')
+numpy = ee_lazy.lazy_import('numpy')
+pandas = ee_lazy.lazy_import('pandas')
 
-from ecoshard import taskgraph
-import geopandas
-import ee
-import numpy
-import pandas
-
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format=(
-        '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
-        ' [%(funcName)s:%(lineno)d] %(message)s'))
-logging.getLogger('fiona').setLevel(logging.WARN)
-logging.getLogger('ecoshard.taskgraph').setLevel(logging.WARN)
 LOGGER = logging.getLogger(__name__)
 
 MAX_N_BANDS = 25
 MODIS_ID = 'MODIS'
-NLCD_ID = 'NLCD'
-CORINE_ID = 'CORINE'
+NLCD_ID = ee_datasets.NLCD_ID
+CORINE_ID = ee_datasets.CORINE_ID
 
 POLY_IN_FIELD = 'POLY-in'
 POLY_OUT_FIELD = 'POLY-out'
 PREV_YEAR_TAG = '--prev-year'
+POINT_INDEX_FIELD = 'point-index'
+POINT_BUFFER_FIELD = 'point-buffer'
+PIXEL_COUNT_TAG = 'pixel-count'
+# MODIS values include 0, so masked pixels of cached MODIS tiles are this
+MODIS_TILE_NODATA = -32768
+# MODIS julian day variables are counted from this date
+MODIS_EPOCH_DATE = '1970-01-01'
 
 RASTER_DB = {
-    NLCD_ID: {
-        'asset_id': 'USGS/NLCD_RELEASES/2016_REL',
-        'valid_years': numpy.array([
-            1992, 2001, 2004, 2006, 2008, 2011, 2013, 2016]),
-        'closest_year_field': 'NLCD-year',
-        'natural_field': 'NLCD-natural',
-        'cultivated_field': 'NLCD-cultivated',
-        'natural_id_list': [(41, 74), (90, 95)],
-        'cultivated_id_list': [(81, 82)],
-        },
-    CORINE_ID: {
-        'asset_id': 'COPERNICUS/CORINE/V20/100m',
-        'valid_years': numpy.array([1990, 2000, 2006, 2012, 2018]),
-        'closest_year_field': 'CORINE-year',
-        'natural_field': 'CORINE-natural',
-        'cultivated_field': 'CORINE-cultivated',
-        'natural_id_list': [(311, 423)],
-        'cultivated_id_list': [(211, 244)],
-    },
+    **ee_datasets.LANDCOVER_DB,
     MODIS_ID: {
         'asset_id': 'MODIS/006/MCD12Q2',
-        'valid_years': numpy.array(range(2001, 2010)),
+        'valid_years': tuple(range(2001, 2010)),
+        'native_scale': 500,
         'julian_day_variables': [
             'Greenup_1',
             'MidGreenup_1',
@@ -74,11 +71,10 @@ RASTER_DB = {
     },
 }
 
-REDUCER = 'mean'
-
 
 def _filter_and_buffer_points_by_year(
-        point_table, lat_field, long_field, year_field, point_buffer):
+        point_table, lat_field, long_field, year_field, point_buffer_list,
+        buffer_shape, buffer_max_error):
     """Separate points in Geopandas table by year.
 
     Args:
@@ -86,22 +82,39 @@ def _filter_and_buffer_points_by_year(
         lat_field (str): fieldname for lat in ``table``
         long_field (str): fieldname for long in ``table``
         year_field (str): fieldname for year in ``table``
-        point_buffer (float): distance in m to buffer points
+        point_buffer_list (list): distances in m to buffer points, each point
+            gets one feature per distance
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N`` shape of
+            the buffers, built client side by ``ee_geometry``
+        buffer_max_error (float): maximum error in m of circle buffers or
+            None for 1% of the buffer distance
 
     Returns:
-        dict of list of ee.Features of points indexed by year from ``table``
+        dict of list of ee.Features of points indexed by year from ``table``,
+        each feature carries its table index in ``POINT_INDEX_FIELD`` and
+        its buffer distance in ``POINT_BUFFER_FIELD``
     """
     pts_by_year = {}
     for year in point_table[year_field].unique():
         pts_by_year[year] = ee.FeatureCollection([
-            ee.Feature(ee.Geometry.Point(
-                row[long_field], row[lat_field]).buffer(point_buffer),
-                row.to_dict())
+            ee.Feature(ee_geometry.buffer_geometry(
+                row[long_field], row[lat_field], point_buffer, buffer_shape,
+                buffer_max_error),
+                {**row.to_dict(), POINT_INDEX_FIELD: int(index),
+                 POINT_BUFFER_FIELD: point_buffer})
             for index, row in point_table[
-                point_table[year_field] == year].dropna().iterrows()])
+                point_table[year_field] == year].dropna().iterrows()
+            for point_buffer in point_buffer_list])
     return pts_by_year
 
 
+def _buffer_field_name(field, point_buffer, point_buffer_list):
+    """Return ``field`` tagged with its buffer if sampling several."""
+    if len(point_buffer_list) == 1:
+        return field
+    return f'{field}-{point_buffer:g}m'
+
+
 def _load_ee_poly(polygon_path, buffer_dist):
     """Read a polygon path from disk and convert to WGS84 GEE Polygon."""
     gp_poly = geopandas.read_file(polygon_path).to_crs('EPSG:4326')
@@ -155,8 +168,16 @@ def _load_ee_poly(polygon_path, buffer_dist):
 
 def _get_closest_num(number_list, candidate):
     """Return closest number in sorted list."""
-    index = (numpy.abs(number_list - candidate)).argmin()
-    return int(number_list[index])
+    number_array = numpy.asarray(number_list)
+    index = (numpy.abs(number_array - candidate)).argmin()
+    return int(number_array[index])
+
+
+def _landcover_image(dataset_id, year):
+    """Return the landcover band of ``dataset_id`` for exactly ``year``."""
+    image_collection = ee.ImageCollection(RASTER_DB[dataset_id]['asset_id'])
+    return image_collection.filter(
+        ee.Filter.eq('system:index', str(year))).first().select('landcover')
 
 
 def _calculate_natural_cultivated_masks(dataset_id, year):
@@ -176,11 +197,7 @@ def _calculate_natural_cultivated_masks(dataset_id, year):
     """
     raster = RASTER_DB[dataset_id]
     closest_year = _get_closest_num(raster['valid_years'], year)
-    image_collection = ee.ImageCollection(raster['asset_id'])
-
-    landcover_image = image_collection.filter(
-        ee.Filter.eq('system:index', str(closest_year))).first().select(
-        'landcover')
+    landcover_image = _landcover_image(dataset_id, closest_year)
 
     mask_dict = {
         'natural_mask': ee.Image(0),
@@ -202,10 +219,322 @@ def _calculate_natural_cultivated_masks(dataset_id, year):
         closest_year)
 
 
-def _sample_modis_by_modis_type_year(
+def _active_modis_years(year):
+    """Yield (active_year, band_name_suffix) with MODIS data for ``year``."""
+    for active_year, band_name_suffix in (
+            (year, ''), (year-1, PREV_YEAR_TAG)):
+        if int(active_year) in RASTER_DB[MODIS_ID]['valid_years']:
+            yield active_year, band_name_suffix
+
+
+def _poly_area_in_out(ee_poly):
+    """Return a feature map function that sets POLY-in/out area fractions."""
+    def area_in_out(feature):
+        """Calculate area inside/outside of poly for given feature."""
+        feature_area = feature.area()
+        area_in = ee_poly.intersection(feature.geometry()).area()
+        return feature.set({
+            POLY_OUT_FIELD: (
+                feature_area.subtract(area_in)).divide(feature_area),
+            POLY_IN_FIELD: area_in.divide(feature_area)})
+    return area_in_out
+
+
+def _dataset_scale(dataset_id, sample_scale, native_scale):
+    """Return the scale in m to sample ``dataset_id`` at."""
+    if native_scale:
+        return RASTER_DB[dataset_id]['native_scale']
+    return sample_scale
+
+
+def _native_projection(dataset_id):
+    """Return the ``ee.Projection`` of the pixel grid of ``dataset_id``."""
+    return ee.ImageCollection(
+        RASTER_DB[dataset_id]['asset_id']).first().select(0).projection()
+
+
+def _dataset_grid(dataset_id, sample_scale, native_scale):
+    """Return the ``reduceRegions`` grid arguments to sample a dataset with.
+
+    At native scale pixels are those of the dataset's own projection,
+    otherwise of a ``sample_scale`` m grid in the projection of the first
+    band reduced.
+    """
+    if native_scale:
+        return {'crs': _native_projection(dataset_id)}
+    return {'scale': sample_scale}
+
+
+def _pixel_count_field(dataset_id):
+    """Return the field reporting pixels sampled per buffer of a dataset."""
+    return f'{dataset_id}-{PIXEL_COUNT_TAG}'
+
+
+def _pixel_count(count_field, projection):
+    """Return a feature map function that counts pixels in the feature.
+
+    Counts pixels of ``projection`` whose centers fall in the feature, so
+    the count is of real dataset pixels rather than of cells of a lat/lon
+    grid that narrow towards the poles.
+    """
+    def pixel_count(feature):
+        """Set ``count_field`` of ``feature`` to its pixel count."""
+        return feature.set(count_field, ee.Image(1).reproject(
+            projection).reduceRegion(
+                reducer=ee.Reducer.count(), geometry=feature.geometry(),
+                crs=projection).get('constant'))
+    return pixel_count
+
+
+def _sample_site_fields(
+        pts_by_year, cult_nat_raster_id_list, ee_poly, polymask,
+        inv_polymask, sample_scale, native_scale, reducer_list):
+    """Sample landcover fractions, closest years and polygon overlap.
+
+    These values only depend on the point, its buffer and its year so they
+    are sampled once per site rather than once per MODIS variable.
+
+    Args:
+        pts_by_year (dict): dictionary of list of points indexed by year.
+        cult_nat_raster_id_list (list): list of entries in RASTER_DB that
+            are used for cultivated and natural masking
+        ee_poly (ee.Geometry): Polygon for testing in/out or None if no
+            polygon is used
+        polymask (ee.Image): 0/1 mask indicating where the polygon is inside
+            or None if no polygon is used
+        inv_polymask (ee.Image): 0/1 mask indicating where the polygon is
+            outside or None if no polygon is used
+        sample_scale (float): scale to sample rasters in meters
+        native_scale (bool): if True, sample each landcover dataset on its
+            own pixel grid in a separate ``reduceRegions`` and report the
+            pixels sampled per buffer
+        reducer_list (list): statistics to calculate for each band
+
+    Returns:
+        set of all property ids generated by this call,
+        list of dict for each point with values for given properties
+    """
+    point_sample_list = []
+    band_id_set = set()
+    field_id_set = set()
+    reducer = ee_reducers.build_reducer(reducer_list)
+    for year in pts_by_year.keys():
+        # bands are grouped by the scale they are sampled at
+        band_list_by_scale = collections.defaultdict(list)
+        grid_by_scale = {}
+        for active_year, band_name_suffix in _active_modis_years(year):
+            for cult_nat_raster_id in cult_nat_raster_id_list:
+                scale = _dataset_scale(
+                    cult_nat_raster_id, sample_scale, native_scale)
+                band_list = band_list_by_scale[scale]
+                # the constant closest year band comes first, without an
+                # explicit crs a native group would use its lat/lon grid
+                grid_by_scale[scale] = _dataset_grid(
+                    cult_nat_raster_id, sample_scale, native_scale)
+                natural_mask, cultivated_mask, closest_year = (
+                    _calculate_natural_cultivated_masks(
+                        cult_nat_raster_id, active_year))
+                closest_year_id = f'{cult_nat_raster_id}-closest-year{band_name_suffix}'
+                band_id_set.add(closest_year_id)
+                band_list.append(
+                    ee.Image(int(closest_year)).rename(closest_year_id))
+                for mask_raster, mask_type in [
+                        (natural_mask, 'natural'),
+                        (cultivated_mask, 'cultivated')]:
+                    mask_band_id = f'{cult_nat_raster_id}-{mask_type}{band_name_suffix}'
+                    band_id_set.add(mask_band_id)
+                    band_list.append(mask_raster.rename(mask_band_id))
+                    if polymask is None:
+                        continue
+                    for poly_mask, poly_field in [
+                            (polymask, POLY_IN_FIELD),
+                            (inv_polymask, POLY_OUT_FIELD)]:
+                        poly_band_id = f'{mask_band_id}-{poly_field}'
+                        band_id_set.add(poly_band_id)
+                        band_list.append(mask_raster.updateMask(
+                            poly_mask).rename(poly_band_id))
+
+        year_points = pts_by_year[year]
+        if ee_poly:
+            year_points = year_points.map(_poly_area_in_out(ee_poly))
+            field_id_set = field_id_set.union(
+                set([POLY_OUT_FIELD, POLY_IN_FIELD]))
+
+        if native_scale:
+            for cult_nat_raster_id in cult_nat_raster_id_list:
+                count_field = _pixel_count_field(cult_nat_raster_id)
+                field_id_set.add(count_field)
+                year_points = year_points.map(_pixel_count(
+                    count_field, _native_projection(cult_nat_raster_id)))
+
+        # each scale group is reduced in turn on the output of the last so
+        # the whole year is still a single request
+        for scale, band_list in band_list_by_scale.items():
+            all_bands = functools.reduce(
+                lambda x, y: x.addBands(y), band_list)
+            year_points = all_bands.reduceRegions(**{
+                'collection': year_points,
+                'reducer': reducer,
+                **grid_by_scale[scale],
+                })
+        if not band_list_by_scale and not ee_poly:
+            continue
+        point_sample_list.extend([
+            x['properties'] for x in year_points.getInfo()['features']])
+
+    return (
+        field_id_set.union(ee_reducers.output_names(
+            band_id_set, reducer_list)),
+        point_sample_list)
+
+
+def _landcover_class_mask(landcover_values, id_list):
+    """Return a bool array, True where a landcover class is in ``id_list``.
+
+    Args:
+        landcover_values (numpy.ndarray): landcover class of each pixel
+        id_list (list): inclusive (min, max) ranges of landcover classes
+
+    Returns:
+        bool numpy array the shape of ``landcover_values``
+    """
+    mask = numpy.zeros(landcover_values.shape, dtype=bool)
+    for (low_id, high_id) in id_list:
+        mask |= (landcover_values >= low_id) & (landcover_values <= high_id)
+    return mask
+
+
+def _sample_landcover_fractions_from_tiles(
+        point_table, lat_field, long_field, year_field, point_buffer_list,
+        buffer_shape, cult_nat_raster_id_list, sample_scale, native_scale,
+        tile_cache, reducer_list):
+    """Calculate natural/cultivated fractions locally from cached tiles.
+
+    Produces the same properties as ``_sample_site_fields`` without
+    a polygon, but pixels are read from ``tile_cache`` so a warmed region
+    needs no GEE requests. A pixel counts as inside the buffer if its center
+    is inside the buffer, circles are tested exactly rather than as the
+    polygon sent to GEE.
+
+    Args:
+        point_table (pandas.Dataframe): table with lat/lng and year fields
+        lat_field (str): fieldname for lat in ``table``
+        long_field (str): fieldname for long in ``table``
+        year_field (str): fieldname for year in ``table``
+        point_buffer_list (list): distances in m to buffer points
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N`` shape of
+            the buffers
+        cult_nat_raster_id_list (list): list of entries in RASTER_DB that
+            are used for cultivated and natural masking
+        sample_scale (float): scale to sample rasters in meters
+        native_scale (bool): if True, read each landcover dataset at its own
+            ``native_scale`` and report the pixels sampled per buffer, tile
+            pixels are ``native_scale`` m wide in both directions so they
+            count about as many pixels as the dataset's own grid
+        tile_cache (ee_tile_cache.TileCache): cache of landcover tiles
+        reducer_list (list): statistics to calculate for each band
+
+    Returns:
+        set of all property ids generated by this call,
+        list of dict for each point and buffer with values for given
+        properties
+    """
+    point_sample_list = []
+    band_id_set = set()
+    field_id_set = set()
+    for (index, row), point_buffer in itertools.product(
+            point_table.dropna().iterrows(), point_buffer_list):
+        point_sample = row.to_dict()
+        point_sample[POINT_INDEX_FIELD] = int(index)
+        point_sample[POINT_BUFFER_FIELD] = point_buffer
+        for active_year, band_name_suffix in _active_modis_years(
+                row[year_field]):
+            for cult_nat_raster_id in cult_nat_raster_id_list:
+                raster = RASTER_DB[cult_nat_raster_id]
+                closest_year = _get_closest_num(
+                    raster['valid_years'], active_year)
+                closest_year_id = f'{cult_nat_raster_id}-closest-year{band_name_suffix}'
+                band_id_set.add(closest_year_id)
+                landcover_values = ee_tile_cache.sample_buffer(
+                    tile_cache, raster['asset_id'], 'landcover',
+                    closest_year,
+                    _dataset_scale(
+                        cult_nat_raster_id, sample_scale, native_scale),
+                    row[long_field], row[lat_field], point_buffer,
+                    functools.partial(
+                        _landcover_image, cult_nat_raster_id, closest_year),
+                    keep_nodata=True, buffer_shape=buffer_shape)
+                if native_scale:
+                    count_field = _pixel_count_field(cult_nat_raster_id)
+                    field_id_set.add(count_field)
+                    point_sample[count_field] = landcover_values.size
+                landcover_values = landcover_values[
+                    landcover_values != ee_tile_cache.TILE_NODATA]
+                band_values_list = [(
+                    closest_year_id,
+                    numpy.full(landcover_values.shape, closest_year))]
+                for id_list, mask_type in [
+                        (raster['natural_id_list'], 'natural'),
+                        (raster['cultivated_id_list'], 'cultivated')]:
+                    mask_band_id = f'{cult_nat_raster_id}-{mask_type}{band_name_suffix}'
+                    band_id_set.add(mask_band_id)
+                    band_values_list.append((
+                        mask_band_id,
+                        _landcover_class_mask(landcover_values, id_list)))
+                for band_id, values in band_values_list:
+                    for reducer_id, value in ee_reducers.local_reduce(
+                            values, reducer_list).items():
+                        if value is None:
+                            continue
+                        point_sample[ee_reducers.output_name(
+                            band_id, reducer_id, reducer_list)] = value
+        point_sample_list.append(point_sample)
+    return (
+        field_id_set.union(ee_reducers.output_names(
+            band_id_set, reducer_list)),
+        point_sample_list)
+
+
+def _fetch_samples(
+        sample_key_set, all_bands, year_points, reducer, grid):
+    """Reduce ``all_bands`` over ``year_points`` and wait for the result.
+
+    This is the only blocking network call of a MODIS request so it is run
+    in the pipeline's executor. ``grid`` holds the ``reduceRegions`` grid
+    arguments from ``_dataset_grid``.
+
+    Returns:
+        ``sample_key_set``,
+        list of dict for each point with values for given properties
+    """
+    year_point_samples = all_bands.reduceRegions(**{
+        'collection': year_points,
+        'reducer': reducer,
+        **grid,
+        }).getInfo()['features']
+    return sample_key_set, [x['properties'] for x in year_point_samples]
+
+
+def _modis_year_image(modis_id, active_year):
+    """Return the single band image of a MODIS variable for a year."""
+    return ee.ImageCollection(RASTER_DB[MODIS_ID]['asset_id']).select(
+        modis_id).filterDate(
+            f'{active_year}-01-01', f'{active_year}-12-31').toBands().rename(
+                modis_id)
+
+
+def _days_since_modis_epoch(active_year):
+    """Return the days from the MODIS epoch to the start of a year."""
+    epoch_date = datetime.strptime(MODIS_EPOCH_DATE, "%Y-%m-%d")
+    current_year = datetime.strptime(f'{active_year}-01-01', "%Y-%m-%d")
+    return (current_year - epoch_date).days
+
+
+def _build_modis_requests(
         pts_by_year, cult_nat_raster_id_list, ee_poly, polymask, inv_polymask,
-        sample_scale, modis_id, modis_type):
-    """Sample MODIS variables by year with NLCD/CORINE/polygon intersection.
+        sample_scale, native_scale, modis_id, modis_type, reducer_list,
+        count_pixels):
+    """Build MODIS sample requests by year with NLCD/CORINE/polygon masks.
 
     Sample all variables from https://docs.google.com/spreadsheets/d/1nbmCKwIG29PF6Un3vN6mQGgFSWG_vhB6eky7wVqVwPo
 
@@ -219,214 +548,608 @@ def _sample_modis_by_modis_type_year(
         inv_polymask (ee.Image): 0/1 mask indicating where the polygon is
             outside
         sample_scale (float): scale to sample rasters in meters
+        native_scale (bool): if True, sample MODIS on its own pixel grid
+            rather than at ``sample_scale``
         modis_id (str): julian or raw band ID from modis
         modis_type (str): either 'julian' or 'raw' corresponding to the
             modis id
+        reducer_list (list): statistics to calculate for each band
+        count_pixels (bool): if True, also report the number of MODIS pixels
+            sampled per buffer
 
     Returns:
-        set of all property ids generated by this call,
-        list of dict for each point with values for given properties
+        list of callables, one per year, that each take no arguments and
+        return a tuple of the set of property ids it generates and a list of
+        dict for each point with values for those properties. Only the graph
+        is built here, nothing is sent to GEE until a callable is invoked.
 
     """
-    modis_db = RASTER_DB[MODIS_ID]
-    # this is the year that julian times are based on for MODIS
-    epoch_date = datetime.strptime('1970-01-01', "%Y-%m-%d")
-    modis_phen = ee.ImageCollection(modis_db['asset_id'])
-
-    # this is the result that is returned -- points with sampled features
-    point_sample_list = []
-
-    band_id_set = set()
+    modis_grid = _dataset_grid(MODIS_ID, sample_scale, native_scale)
 
+    request_list = []
     for year in pts_by_year.keys():
-        LOGGER.info(f'processing year {year}')
+        LOGGER.debug(f'building {modis_id} request for year {year}')
+        band_id_set = set()
         band_list = []
-        for active_year, band_name_suffix in (
-                (year, ''), (year-1, PREV_YEAR_TAG)):
-            # active year is stored as a string
-            if int(active_year) in modis_db['valid_years']:
-                LOGGER.info(
-                    f'modis active_year: {active_year}/{band_name_suffix}')
-
-                for cult_nat_raster_id in [''] + cult_nat_raster_id_list:
-                    if cult_nat_raster_id:
-                        natural_mask, cultivated_mask, closest_year = (
-                            _calculate_natural_cultivated_masks(
-                                cult_nat_raster_id, active_year))
-                        closest_year_id = f'{cult_nat_raster_id}-closest-year{band_name_suffix}'
-                        band_id_set.add(closest_year_id)
-                        band_list.append((ee.Image(
-                            int(closest_year)).rename(closest_year_id),
-                            [closest_year_id]))
-                        mask_loop_args = [
-                            (natural_mask, f'-{cult_nat_raster_id}-natural{band_name_suffix}'),
-                            (cultivated_mask, f'-{cult_nat_raster_id}-cultivated{band_name_suffix}')]
-
-                        for mask_raster, band_suffix in mask_loop_args:
-                            cult_ag_band_id = f'{band_suffix[1:]}'
-                            band_id_set.add(cult_ag_band_id)
-                            band_list.append(
-                                (mask_raster.rename(cult_ag_band_id),
-                                 [cult_ag_band_id]))
-                    else:
-                        mask_loop_args = [(ee.Image(1), band_name_suffix)]
-
-                    for mask_raster, band_suffix in mask_loop_args:
-                        # Get date based values and convert to be days since start
-                        # of active_year
-                        if modis_type == 'julian':
-                            modis_band_rename = (
-                                f'{MODIS_ID}-{modis_id}{band_suffix}')
-                            band_id_set.add(modis_band_rename)
-                            bands_since_1970 = modis_phen.select(modis_id).filterDate(
-                                    f'{active_year}-01-01',
-                                    f'{active_year}-12-31')
-                            current_year = datetime.strptime(
-                                f'{active_year}-01-01', "%Y-%m-%d")
-                            days_since_epoch = (current_year - epoch_date).days
-                            julian_day_bands = bands_since_1970.toBands().subtract(
-                                    days_since_epoch).updateMask(mask_raster)
-                            band_list.append(
-                                (julian_day_bands.rename(modis_band_rename),
-                                    [modis_band_rename]))
-
-                        if modis_type == 'raw':
-                            raw_variable_bands = modis_phen.select(modis_id).filterDate(
-                                f'{active_year}-01-01', f'{active_year}-12-31').toBands().updateMask(mask_raster)
-                            raw_band_rename = f'{MODIS_ID}-{modis_id}{band_suffix}'
-                            band_id_set.add(raw_band_rename)
-                            band_list.append(
-                                (raw_variable_bands.rename(raw_band_rename),
-                                    [raw_band_rename]))
+        for active_year, band_name_suffix in _active_modis_years(year):
+            modis_bands = _modis_year_image(modis_id, active_year)
+            if modis_type == 'julian':
+                # Get date based values and convert to be days since start
+                # of active_year
+                modis_bands = modis_bands.subtract(
+                    _days_since_modis_epoch(active_year))
+
+            mask_loop_args = [(ee.Image(1), band_name_suffix)]
+            for cult_nat_raster_id in cult_nat_raster_id_list:
+                natural_mask, cultivated_mask, _ = (
+                    _calculate_natural_cultivated_masks(
+                        cult_nat_raster_id, active_year))
+                mask_loop_args += [
+                    (natural_mask, f'-{cult_nat_raster_id}-natural{band_name_suffix}'),
+                    (cultivated_mask, f'-{cult_nat_raster_id}-cultivated{band_name_suffix}')]
+
+            for mask_raster, band_suffix in mask_loop_args:
+                modis_band_rename = f'{MODIS_ID}-{modis_id}{band_suffix}'
+                band_id_set.add(modis_band_rename)
+                band_list.append(
+                    (modis_bands.updateMask(mask_raster).rename(
+                        modis_band_rename), [modis_band_rename]))
 
         year_points = pts_by_year[year]
-        # determine area in/out of point area
+        # mask every band to inside/outside the polygon
         if ee_poly:
-
-            def area_in_out(feature):
-                """Calculate area inside/outside of poly for given feature."""
-                feature_area = feature.area()
-                area_in = ee_poly.intersection(feature.geometry()).area()
-                return feature.set({
-                    POLY_OUT_FIELD: (
-                        feature_area.subtract(area_in)).divide(feature_area),
-                    POLY_IN_FIELD: area_in.divide(feature_area)})
-            year_points = year_points.map(area_in_out)
-            band_id_set = band_id_set.union(
-                set([POLY_OUT_FIELD, POLY_IN_FIELD]))
-
             for band, band_name_list in list(band_list):
-                # remove the "closest year" constants that don't need masking
-                local_band_name_list = [
-                    band_name for band_name in band_name_list
-                    if 'closest-year' not in band_name]
-                if local_band_name_list:
-                    poly_in_band_names = [
-                        f'{name}-{POLY_IN_FIELD}' for name in local_band_name_list]
-                    poly_out_band_names = [
-                        f'{name}-{POLY_OUT_FIELD}' for name in local_band_name_list]
-                    band_id_set = band_id_set.union(
-                        set(poly_in_band_names+poly_out_band_names))
-
-                # Julian variables should be masked out
-                # RASTER_DB[MODIS_ID]['julian_day_variables']
-                julian_day_band_names = []
-                if modis_type == 'julian':
-                    julian_day_band_names = [
-                        name for name in local_band_name_list if any(
-                            sub in name for sub in
-                            RASTER_DB[MODIS_ID]['julian_day_variables'])]
-                    if julian_day_band_names:
-                        julian_day_subset = band.select(julian_day_band_names)
-                        band_list.append((
-                            ee.Image(julian_day_subset).updateMask(
-                                polymask).rename(
-                                poly_in_band_names), poly_in_band_names))
-                        band_list.append((ee.Image(julian_day_subset).updateMask(
-                                inv_polymask).rename(
-                                    poly_out_band_names), poly_out_band_names))
-
-                # All other variables should be proportional and set to 0
-                # outside of their mask with a multiply
-                other_band_names = list(
-                    set(band_name_list)-set(julian_day_band_names))
-                if other_band_names:
-                    other_subset = band.select(other_band_names)
-                    band_list.append((
-                        ee.Image(other_subset).updateMask(polymask).rename(poly_in_band_names), poly_in_band_names))
-                    band_list.append((ee.Image(other_subset).updateMask(inv_polymask).rename(poly_out_band_names), poly_out_band_names))
-
-        band_list.append(
-            (ee.Image(polymask).rename('polymask'), ['polymask']))
-        band_list.append(
-            (ee.Image(inv_polymask).rename('inv_polymask'), ['inv_polymask']))
+                poly_in_band_names = [
+                    f'{name}-{POLY_IN_FIELD}' for name in band_name_list]
+                poly_out_band_names = [
+                    f'{name}-{POLY_OUT_FIELD}' for name in band_name_list]
+                band_id_set = band_id_set.union(
+                    set(poly_in_band_names+poly_out_band_names))
+                band_list.append((
+                    band.updateMask(polymask).rename(poly_in_band_names),
+                    poly_in_band_names))
+                band_list.append((
+                    band.updateMask(inv_polymask).rename(poly_out_band_names),
+                    poly_out_band_names))
+
+        if not band_list:
+            continue
+
+        sample_key_set = ee_reducers.output_names(band_id_set, reducer_list)
+        if count_pixels:
+            count_field = _pixel_count_field(MODIS_ID)
+            sample_key_set.add(count_field)
+            year_points = year_points.map(
+                _pixel_count(count_field, _native_projection(MODIS_ID)))
 
         all_bands = functools.reduce(lambda x, y: x.addBands(y), [b[0] for b in band_list])
+        all_band_names = [name for b in band_list for name in b[1]]
+        # a year with no landcover masks or polygon may have a single band
+        reducer = ee_reducers.build_reducer(reducer_list, all_band_names)
+        request_list.append(functools.partial(
+            _fetch_samples, sample_key_set, all_bands, year_points, reducer,
+            modis_grid))
 
-        year_point_samples = None
-        year_point_samples = all_bands.reduceRegions(**{
-            'collection': year_points,
-            'reducer': REDUCER,
-            'scale': sample_scale,
-            }).getInfo()['features']
-        point_sample_list.extend([
-            x['properties'] for x in year_point_samples])
+    return request_list
 
-    return band_id_set, point_sample_list
 
+def _sample_modis_from_tiles(
+        point_table, lat_field, long_field, year_field, point_buffer_list,
+        buffer_shape, cult_nat_raster_id_list, sample_scale, native_scale,
+        modis_id, modis_type, tile_cache, reducer_list, count_pixels):
+    """Sample one MODIS variable with its landcover masks from cached tiles.
 
-def _sample_table(
-        point_table, min_index, max_index, lat_field, long_field, year_field,
-        point_buffer, cult_nat_raster_id_list, polygon_path, sample_scale):
-    local_point_table = point_table[min_index:max_index]
+    Produces the same properties as the requests of
+    ``_build_modis_requests`` without a polygon. MODIS and landcover tiles
+    are read on the same grid so the pixels of both line up and the
+    natural/cultivated masks are applied locally, a warmed region needs no
+    GEE requests.
+
+    Args:
+        point_table (pandas.Dataframe): table with lat/lng and year fields
+        lat_field (str): fieldname for lat in ``table``
+        long_field (str): fieldname for long in ``table``
+        year_field (str): fieldname for year in ``table``
+        point_buffer_list (list): distances in m to buffer points
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N`` shape of
+            the buffers
+        cult_nat_raster_id_list (list): list of entries in RASTER_DB that
+            are used for cultivated and natural masking
+        sample_scale (float): scale to sample rasters in meters
+        native_scale (bool): if True, read MODIS and the masks at the MODIS
+            ``native_scale`` rather than ``sample_scale``
+        modis_id (str): julian or raw band ID from modis
+        modis_type (str): either 'julian' or 'raw' corresponding to the
+            modis id
+        tile_cache (ee_tile_cache.TileCache): cache of MODIS and landcover
+            tiles
+        reducer_list (list): statistics to calculate for each band
+        count_pixels (bool): if True, also report the number of MODIS pixels
+            sampled per buffer
+
+    Returns:
+        set of all property ids generated by this call,
+        list of dict for each point and buffer with values for given
+        properties
+    """
+    modis_scale = _dataset_scale(MODIS_ID, sample_scale, native_scale)
+    count_field = _pixel_count_field(MODIS_ID)
+    point_sample_list = []
+    band_id_set = set()
+    field_id_set = set()
+    for (index, row), point_buffer in itertools.product(
+            point_table.dropna().iterrows(), point_buffer_list):
+        point_sample = {
+            POINT_INDEX_FIELD: int(index), POINT_BUFFER_FIELD: point_buffer}
+        # iterrows gives floats for every field of a mixed row
+        for active_year, band_name_suffix in _active_modis_years(
+                int(row[year_field])):
+            modis_values = ee_tile_cache.sample_buffer(
+                tile_cache, RASTER_DB[MODIS_ID]['asset_id'], modis_id,
+                active_year, modis_scale, row[long_field], row[lat_field],
+                point_buffer, functools.partial(
+                    _modis_year_image, modis_id, active_year),
+                keep_nodata=True, buffer_shape=buffer_shape,
+                nodata=MODIS_TILE_NODATA)
+            if count_pixels:
+                field_id_set.add(count_field)
+                point_sample[count_field] = modis_values.size
+            valid_mask = modis_values != MODIS_TILE_NODATA
+            modis_values = modis_values.astype(numpy.float64)
+            if modis_type == 'julian':
+                modis_values -= _days_since_modis_epoch(active_year)
+
+            mask_list = [(valid_mask, band_name_suffix)]
+            for cult_nat_raster_id in cult_nat_raster_id_list:
+                raster = RASTER_DB[cult_nat_raster_id]
+                closest_year = _get_closest_num(
+                    raster['valid_years'], active_year)
+                # read on the MODIS grid so every value lines up with a
+                # MODIS pixel
+                landcover_values = ee_tile_cache.sample_buffer(
+                    tile_cache, raster['asset_id'], 'landcover',
+                    closest_year, modis_scale, row[long_field],
+                    row[lat_field], point_buffer, functools.partial(
+                        _landcover_image, cult_nat_raster_id, closest_year),
+                    keep_nodata=True, buffer_shape=buffer_shape)
+                for id_list, mask_type in [
+                        (raster['natural_id_list'], 'natural'),
+                        (raster['cultivated_id_list'], 'cultivated')]:
+                    mask_list.append((
+                        valid_mask & _landcover_class_mask(
+                            landcover_values, id_list),
+                        f'-{cult_nat_raster_id}-{mask_type}'
+                        f'{band_name_suffix}'))
+
+            for mask, band_suffix in mask_list:
+                modis_band_rename = f'{MODIS_ID}-{modis_id}{band_suffix}'
+                band_id_set.add(modis_band_rename)
+                for reducer_id, value in ee_reducers.local_reduce(
+                        modis_values[mask], reducer_list).items():
+                    if value is None:
+                        continue
+                    point_sample[ee_reducers.output_name(
+                        modis_band_rename, reducer_id, reducer_list)] = value
+        point_sample_list.append(point_sample)
+    return (
+        field_id_set.union(ee_reducers.output_names(
+            band_id_set, reducer_list)),
+        point_sample_list)
+
+
+def _site_config(
+        cult_nat_raster_id_list, polygon_path, sample_scale, native_scale,
+        buffer_shape, buffer_max_error, use_tile_cache, reducer_list):
+    """Describe the settings that static per-site fields depend on."""
+    return json.dumps({
+        'cult_nat_raster_id_list': cult_nat_raster_id_list,
+        'polygon_path': (
+            os.path.abspath(polygon_path) if polygon_path else None),
+        'sample_scale': sample_scale,
+        'native_scale': native_scale,
+        'buffer_shape': buffer_shape,
+        'buffer_max_error': buffer_max_error,
+        # fractions from cached tiles count whole pixels inside the buffer
+        # while GEE weights pixels by their overlap, so they never mix
+        'use_tile_cache': use_tile_cache,
+        'reducer_list': reducer_list,
+        }, sort_keys=True)
+
+
+def _batch_config(
+        lat_field, long_field, year_field, point_buffer_list, buffer_shape,
+        buffer_max_error, cult_nat_raster_id_list, polygon_path, sample_scale,
+        native_scale, use_tile_cache, reducer_list):
+    """Describe the settings that every sampled field of a batch depends on."""
+    return json.dumps({
+        'site_config': _site_config(
+            cult_nat_raster_id_list, polygon_path, sample_scale,
+            native_scale, buffer_shape, buffer_max_error, use_tile_cache,
+            reducer_list),
+        'fields': [lat_field, long_field, year_field],
+        'point_buffer_list': point_buffer_list,
+        'modis_variable_list': _modis_variable_list(),
+        }, sort_keys=True)
+
+
+def _sample_site_table(
+        point_table, lat_field, long_field, year_field, point_buffer_list,
+        buffer_shape, buffer_max_error, cult_nat_raster_id_list,
+        polygon_path, ee_poly, polymask, inv_polymask, sample_scale,
+        native_scale, tile_cache, site_cache_path, reducer_list):
+    """Sample static per-site fields, reusing any that are already cached.
+
+    Args:
+        point_table (pandas.Dataframe): table with lat/lng and year fields
+        lat_field (str): fieldname for lat in ``table``
+        long_field (str): fieldname for long in ``table``
+        year_field (str): fieldname for year in ``table``
+        point_buffer_list (list): distances in m to buffer points
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N`` shape of
+            the buffers
+        buffer_max_error (float): maximum error in m of circle buffers or
+            None for 1% of the buffer distance
+        cult_nat_raster_id_list (list): list of entries in RASTER_DB that
+            are used for cultivated and natural masking
+        polygon_path (str): path to polygon used for in/out or None
+        ee_poly (ee.Geometry): Polygon for testing in/out or None
+        polymask (ee.Image): 0/1 mask inside the polygon or None
+        inv_polymask (ee.Image): 0/1 mask outside the polygon or None
+        sample_scale (float): scale to sample rasters in meters
+        native_scale (bool): if True, sample each dataset at its own
+            ``native_scale``
+        tile_cache (ee_tile_cache.TileCache): if not None, cache of
+            landcover tiles used to calculate landcover fractions locally,
+            only used without ``polygon_path``
+        site_cache_path (str): if not None, path to the SQLite site cache
+        reducer_list (list): statistics to calculate for each band
 
+    Returns:
+        set of all property ids generated by this call,
+        list of dict for each point with values for given properties
+    """
+    point_table = point_table.dropna()
     sample_key_set = set()
     sample_list = []
-    for modis_id, modis_type in [
-            (x, 'julian') for x in RASTER_DB[MODIS_ID]['julian_day_variables']] + \
-            [(x, 'raw') for x in RASTER_DB[MODIS_ID]['raw_variables']]:
-        LOGGER.debug(f'processing {modis_id}')
-        ee.Initialize()
+
+    # a site is a point sampled at one of the buffer distances
+    site_key_by_index = {
+        (index, point_buffer): ee_site_cache.site_key(
+            row[long_field], row[lat_field], point_buffer, row[year_field])
+        for index, row in point_table.iterrows()
+        for point_buffer in point_buffer_list}
+    site_config = _site_config(
+        cult_nat_raster_id_list, polygon_path, sample_scale, native_scale,
+        buffer_shape, buffer_max_error,
+        tile_cache is not None and not polygon_path, reducer_list)
+    site_cache = None
+    if site_cache_path:
+        site_cache = ee_site_cache.SiteCache(site_cache_path)
+        cached_fields = site_cache.get_many(
+            site_config, list(site_key_by_index.values()))
+        cached_index_list = []
+        for index, row in point_table.iterrows():
+            fields_list = [
+                cached_fields.get(site_key_by_index[(index, point_buffer)])
+                for point_buffer in point_buffer_list]
+            if any(fields is None for fields in fields_list):
+                continue
+            cached_index_list.append(index)
+            for point_buffer, fields in zip(point_buffer_list, fields_list):
+                sample_key_set = sample_key_set.union(fields)
+                sample_list.append({
+                    **row.to_dict(), POINT_INDEX_FIELD: int(index),
+                    POINT_BUFFER_FIELD: point_buffer, **fields})
+        LOGGER.info(
+            f'{len(cached_index_list)} of {point_table.shape[0]} sites are '
+            'cached')
+        point_table = point_table.drop(index=cached_index_list)
+
+    if point_table.shape[0] == 0:
+        return sample_key_set, sample_list
+
+    if tile_cache is not None and not polygon_path:
+        local_sample_keys, local_sample_list = (
+            _sample_landcover_fractions_from_tiles(
+                point_table, lat_field, long_field, year_field,
+                point_buffer_list, buffer_shape, cult_nat_raster_id_list,
+                sample_scale, native_scale, tile_cache, reducer_list))
+    else:
         pts_by_year = _filter_and_buffer_points_by_year(
-            local_point_table, lat_field, long_field, year_field, point_buffer)
+            point_table, lat_field, long_field, year_field,
+            point_buffer_list, buffer_shape, buffer_max_error)
+        local_sample_keys, local_sample_list = _sample_site_fields(
+            pts_by_year, cult_nat_raster_id_list, ee_poly, polymask,
+            inv_polymask, sample_scale, native_scale, reducer_list)
+
+    if site_cache is not None:
+        site_cache.put_many(site_config, {
+            site_key_by_index[(
+                point_sample[POINT_INDEX_FIELD],
+                point_sample[POINT_BUFFER_FIELD])]: {
+                key: point_sample[key] for key in local_sample_keys
+                if key in point_sample}
+            for point_sample in local_sample_list})
+    sample_key_set = sample_key_set.union(local_sample_keys)
+    sample_list.extend(local_sample_list)
+    return sample_key_set, sample_list
+
+
+class _StageCounter(object):
+    """Number of items and busy time of one pipeline stage."""
+
+    def __init__(self, stage_id):
+        """Create an empty counter for ``stage_id``."""
+        self.stage_id = stage_id
+        self.n_items = 0
+        self.busy_time = 0.0
+
+    def add(self, busy_time):
+        """Record one item that kept the stage busy for ``busy_time`` s."""
+        self.n_items += 1
+        self.busy_time += busy_time
+
+    def __str__(self):
+        """Report throughput of the stage."""
+        rate = self.n_items / self.busy_time if self.busy_time > 0 else 0.0
+        return (
+            f'{self.stage_id}: {self.n_items} items in '
+            f'{self.busy_time:.1f}s busy ({rate:.2f} items/s)')
+
+
+def _modis_variable_list():
+    """Return (modis_id, modis_type) of every MODIS variable to sample."""
+    return (
+        [(x, 'julian') for x in RASTER_DB[MODIS_ID]['julian_day_variables']] +
+        [(x, 'raw') for x in RASTER_DB[MODIS_ID]['raw_variables']])
 
-        ee_poly, polymask, inv_polymask = None, None, None
-        if polygon_path:
-            ee_poly, polymask, inv_polymask = _load_ee_poly(
-                polygon_path, point_buffer)
 
-        local_sample_keys, local_sample_list = _sample_modis_by_modis_type_year(
-            pts_by_year, cult_nat_raster_id_list, ee_poly, polymask, inv_polymask,
-            sample_scale, modis_id, modis_type)
-        ee.Reset()
-        sample_key_set = sample_key_set.union(local_sample_keys)
-        sample_list.append(local_sample_list)
+def _build_batch_requests(
+        point_table, min_index, max_index, lat_field, long_field, year_field,
+        point_buffer_list, buffer_shape, buffer_max_error,
+        cult_nat_raster_id_list, polygon_path, ee_poly, polymask,
+        inv_polymask, sample_scale, native_scale, tile_cache,
+        site_cache_path, reducer_list):
+    """Build every request needed to sample one batch of ``point_table``.
 
-    combined_sample_list = []
-    for single_sample_list in zip(*sample_list):
-        print(single_sample_list)
-        combined_sample_list.append(functools.reduce(
-            lambda x, y: x | y, single_sample_list))
-    return (sample_key_set, combined_sample_list)
+    Returns:
+        list of callables that take no arguments and return a tuple of the
+        set of property ids they generate and a list of dict for each point
+        with values for those properties
+    """
+    local_point_table = point_table[min_index:max_index]
 
+    request_list = []
+    if cult_nat_raster_id_list or polygon_path:
+        request_list.append(functools.partial(
+            _sample_site_table,
+            local_point_table, lat_field, long_field, year_field,
+            point_buffer_list, buffer_shape, buffer_max_error,
+            cult_nat_raster_id_list, polygon_path, ee_poly, polymask,
+            inv_polymask, sample_scale, native_scale, tile_cache,
+            site_cache_path, reducer_list))
+
+    if tile_cache is not None and not polygon_path:
+        # pixel counts are the same for every variable so only count once
+        request_list.extend(
+            functools.partial(
+                _sample_modis_from_tiles,
+                local_point_table, lat_field, long_field, year_field,
+                point_buffer_list, buffer_shape, cult_nat_raster_id_list,
+                sample_scale, native_scale, modis_id, modis_type, tile_cache,
+                reducer_list, native_scale and variable_index == 0)
+            for variable_index, (modis_id, modis_type) in enumerate(
+                _modis_variable_list()))
+        return request_list
+
+    pts_by_year = _filter_and_buffer_points_by_year(
+        local_point_table, lat_field, long_field, year_field,
+        point_buffer_list, buffer_shape, buffer_max_error)
+    for variable_index, (modis_id, modis_type) in enumerate(
+            _modis_variable_list()):
+        # pixel counts are the same for every variable so only count once
+        request_list.extend(_build_modis_requests(
+            pts_by_year, cult_nat_raster_id_list, ee_poly, polymask,
+            inv_polymask, sample_scale, native_scale, modis_id, modis_type,
+            reducer_list, native_scale and variable_index == 0))
+    return request_list
+
+
+def _accumulate_samples(
+        accumulator, sample_key_set, sample_list, point_buffer_list):
+    """Write the samples of one request into ``accumulator`` in place.
 
-def main():
-    """Entry point."""
-    parser = argparse.ArgumentParser(
-        description='Sample MODIS biophyisical areas on point data with additional information specified about cultivated/natural areas.')
+    Args:
+        accumulator (ee_accumulator.SampleAccumulator): accumulator with a
+            row for every point
+        sample_key_set (set): property ids sampled by the request
+        sample_list (list): list of dict for each point and buffer
+        point_buffer_list (list): buffer distances the points were sampled
+            at, sampled fields are tagged with their buffer if there are
+            several
+
+    Returns:
+        None
+    """
+    field_name_by_key_buffer = {
+        (key, point_buffer): _buffer_field_name(
+            key, point_buffer, point_buffer_list)
+        for key in sample_key_set for point_buffer in point_buffer_list}
+    accumulator.add_keys(field_name_by_key_buffer.values())
+    for point_sample in sample_list:
+        point_buffer = point_sample[POINT_BUFFER_FIELD]
+        accumulator.set_values(point_sample[POINT_INDEX_FIELD], {
+            field_name_by_key_buffer[(key, point_buffer)]: point_sample[key]
+            for key in sample_key_set if key in point_sample})
+
+
+async def _run_sample_pipeline(
+        batch_args_list, accumulator, point_buffer_list, n_workers,
+        queue_size, batch_cache=None, batch_key_list=None):
+    """Sample all batches with overlapping build, fetch and merge stages.
+
+    Requests for the next batches are built on the event loop while up to
+    ``n_workers`` requests wait on GEE in a thread pool, and finished
+    results are written into ``accumulator`` as they arrive. Both queues
+    between the stages are bounded by ``queue_size`` so building never runs
+    far ahead of GEE. Batches found in ``batch_cache`` go straight to the
+    merge stage and every other batch is stored there once all its requests
+    are merged. An error in any stage cancels the others and is raised.
+
+    Args:
+        batch_args_list (list): list of argument tuples for
+            ``_build_batch_requests``, one per batch
+        accumulator (ee_accumulator.SampleAccumulator): accumulator with a
+            row for every point in the batches
+        point_buffer_list (list): buffer distances the points are sampled at
+        n_workers (int): number of requests in flight at once
+        queue_size (int): maximum number of items waiting between stages
+        batch_cache (ee_batch_cache.BatchCache): cache of finished batches
+            or None to sample every batch
+        batch_key_list (list): ``batch_cache`` key of each batch, only used
+            with ``batch_cache``
+
+    Returns:
+        None
+    """
+    loop = asyncio.get_running_loop()
+    request_queue = asyncio.Queue(maxsize=queue_size)
+    result_queue = asyncio.Queue(maxsize=queue_size)
+    counter_dict = {
+        stage_id: _StageCounter(stage_id)
+        for stage_id in ['build', 'fetch', 'merge']}
+    n_pending_by_batch = {}
+    # results of each uncached batch until all its requests are merged
+    result_list_by_batch = {}
+
+    async def build_stage():
+        for batch_index, batch_args in enumerate(batch_args_list):
+            if batch_cache is not None:
+                cached_result_list = batch_cache.get(
+                    batch_key_list[batch_index])
+                if cached_result_list is not None:
+                    n_pending_by_batch[batch_index] = len(
+                        cached_result_list)
+                    for result in cached_result_list:
+                        await result_queue.put((batch_index, result, True))
+                    continue
+                result_list_by_batch[batch_index] = []
+            start_time = time.time()
+            request_list = _build_batch_requests(*batch_args)
+            counter_dict['build'].add(time.time() - start_time)
+            n_pending_by_batch[batch_index] = len(request_list)
+            for request in request_list:
+                await request_queue.put((batch_index, request))
+        for _ in range(n_workers):
+            await request_queue.put(None)
+
+    async def fetch_stage(executor):
+        while True:
+            item = await request_queue.get()
+            if item is None:
+                break
+            batch_index, request = item
+            start_time = time.time()
+            result = await loop.run_in_executor(executor, request)
+            counter_dict['fetch'].add(time.time() - start_time)
+            await result_queue.put((batch_index, result, False))
+
+    async def merge_stage():
+        while True:
+            item = await result_queue.get()
+            if item is None:
+                break
+            batch_index, result, is_cached = item
+            sample_key_set, sample_list = result
+            start_time = time.time()
+            _accumulate_samples(
+                accumulator, sample_key_set, sample_list, point_buffer_list)
+            if batch_cache is not None and not is_cached:
+                result_list_by_batch[batch_index].append(result)
+            n_pending_by_batch[batch_index] -= 1
+            if n_pending_by_batch[batch_index] == 0:
+                if batch_cache is not None and not is_cached:
+                    batch_cache.put(
+                        batch_key_list[batch_index],
+                        result_list_by_batch.pop(batch_index))
+                LOGGER.info(
+                    f'finished batch {batch_index+1} of '
+                    f'{len(batch_args_list)}'
+                    f'{" from cache" if is_cached else ""}, ' + '; '.join(
+                        str(counter) for counter in counter_dict.values()))
+            counter_dict['merge'].add(time.time() - start_time)
+
+    async def produce_stage(executor):
+        stage_task_list = [asyncio.ensure_future(build_stage())] + [
+            asyncio.ensure_future(fetch_stage(executor))
+            for _ in range(n_workers)]
+        try:
+            await asyncio.gather(*stage_task_list)
+        except BaseException:
+            for task in stage_task_list:
+                task.cancel()
+            raise
+        await result_queue.put(None)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            n_workers, initializer=ee_session.worker_initializer) as executor:
+        task_list = [
+            asyncio.ensure_future(produce_stage(executor)),
+            asyncio.ensure_future(merge_stage())]
+        try:
+            # a failed merge would otherwise leave the fetchers blocked on
+            # a full result queue forever
+            done_set, _ = await asyncio.wait(
+                task_list, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done_set:
+                task.result()
+            # the producer finished first, so wait for the merge to drain
+            await asyncio.gather(*task_list)
+        except BaseException:
+            for task in task_list:
+                task.cancel()
+            raise
+
+    for counter in counter_dict.values():
+        LOGGER.info(str(counter))
+
+
+def add_arguments(parser):
+    """Add the point sampling options to ``parser``."""
     parser.add_argument('csv_path', help='path to CSV data table')
     parser.add_argument('--year_field', default='crop_year', help='field name in csv_path for year, default `year_field`')
     parser.add_argument('--long_field', default='field_longitude', help='field name in csv_path for longitude, default `long_field`')
     parser.add_argument('--lat_field', default='field_latitude', help='field name in csv_path for latitude, default `lat_field')
-    parser.add_argument('--point_buffer', type=float, default=1000, help='buffer distance in meters around point to do aggregate analysis, default 1000m')
+    parser.add_argument('--point_buffer', type=float, nargs='+', default=[1000.0], help='one or more buffer distances in meters around point to do aggregate analysis, default 1000m. All distances are sampled in the same pass and with more than one distance output columns are suffixed with -{distance}m')
+    parser.add_argument('--buffer_shape', default=ee_geometry.DEFAULT_BUFFER_SHAPE, help='shape of the buffer around each point, one of circle, square or polygon:N for a regular N sided polygon. Buffers are sent to GEE as a few explicit vertices, squares and polygons have the same area as the circle, defaults to circle')
+    parser.add_argument('--buffer_max_error', type=float, help='maximum distance in meters between a circle buffer and the polygon approximating it, fewer vertices are cheaper to sample, defaults to 1%% of the buffer distance like GEE')
     parser.add_argument('--nlcd', default=False, action='store_true', help='sample the NCLD landcover for cultivated/natural masks')
     parser.add_argument('--corine', default=False, action='store_true', help='sample the CORINE landcover for cultivated/natural masks')
     parser.add_argument('--polygon_path', type=str, help='this polygon modifies samples to include inside and outside of the sampled datasets')
     parser.add_argument('--n_rows', type=int, help='limit the number of points read from the CSV to this value, useful for debugging.')
     parser.add_argument('--sample_scale', type=float, default=500.0, help='scale to sample rasters in meters, defaults to 500m')
+    parser.add_argument('--native_scale', action='store_true', help='ignore --sample_scale and sample each dataset on its own pixel grid (NLCD 30m, CORINE 100m, MODIS 500m) in a separate reduceRegions per dataset, reporting the pixels sampled per buffer in {dataset}-pixel-count columns')
+    parser.add_argument('--reducers', default=ee_reducers.DEFAULT_REDUCERS, help='comma separated statistics to calculate in one pass over each buffer, any of mean, median, mode, min, max, sum, count, stdDev, variance or a percentile like p90, defaults to mean. With more than one statistic output columns are named {band}_{statistic}')
     parser.add_argument('--batch_size', type=int, default=100, help='point batch size to limit processing on GEE, defaults to 100')
+    parser.add_argument('--n_workers', type=int, default=4, help='number of GEE requests in flight at once, defaults to 4')
+    parser.add_argument('--queue_size', type=int, default=16, help='maximum number of requests built ahead of GEE or waiting to be merged, defaults to 16')
+    parser.add_argument('--tile_cache_dir', type=str, help='if set, MODIS and NLCD/CORINE landcover tiles are cached in this directory and natural/cultivated fractions and masked MODIS statistics are calculated locally, so a warmed region needs no GEE requests, not supported with --polygon_path')
+    parser.add_argument('--tile_cache_max_gb', type=float, default=10.0, help='maximum size of --tile_cache_dir before least recently used tiles are removed, defaults to 10GB')
+    parser.add_argument('--site_cache_path', type=str, help='if set, landcover fractions and polygon overlap are stored per site in this SQLite database and only uncached sites are sampled on later runs')
+    parser.add_argument('--batch_cache_dir', type=str, help='if set, the results of every finished batch are stored in this directory and an interrupted run with the same options skips them when restarted')
+    parser.add_argument('--shard', type=str, help='only sample shard K of N of the table, given as K/N, and write a shard table and manifest that `python ee_shard.py merge` combines once every shard is done')
+    parser.add_argument('--shard_by', default='row', choices=ee_shard.SHARD_BY_OPTIONS, help='assign rows to shards by a hash of each row, or of the spatial tile it is in so nearby points share a shard, defaults to row')
     parser.add_argument('--authenticate', action='store_true', help='Pass this flag if you need to reauthenticate with GEE')
-    args = parser.parse_args()
+
+
+def run(args):
+    """Sample MODIS and landcover datasets at the points of ``args.csv_path``."""
+    reducer_list = ee_reducers.parse_reducers(args.reducers)
+    # fail on a bad shape before any GEE work is done
+    ee_geometry.parse_buffer_shape(args.buffer_shape)
+    shard_index, n_shards = None, None
+    if args.shard:
+        shard_index, n_shards = ee_shard.parse_shard_spec(args.shard)
 
     if args.authenticate:
         ee.Authenticate()
@@ -440,11 +1163,13 @@ def main():
             args.year_field: lambda x: int(x),
         },
         nrows=args.n_rows)
-
-    sample_keys = set()
-    sample_list = []
-
-    task_graph = taskgraph.TaskGraph('.', -1)
+    if args.shard:
+        # row indexes are kept so shards can be merged back in order
+        point_table = point_table[ee_shard.shard_mask(
+            point_table, args.lat_field, args.long_field, args.year_field,
+            shard_index, n_shards, args.shard_by)]
+        LOGGER.info(
+            f'sampling {point_table.shape[0]} rows in shard {args.shard}')
 
     cult_nat_raster_id_list = []
     if args.nlcd:
@@ -452,40 +1177,113 @@ def main():
     if args.corine:
         cult_nat_raster_id_list.append(CORINE_ID)
 
+    ee_session.get_session()
+    ee_poly, polymask, inv_polymask = None, None, None
+    if args.polygon_path:
+        ee_poly, polymask, inv_polymask = _load_ee_poly(
+            args.polygon_path, max(args.point_buffer))
+
+    # one cache for the whole run so its size count is shared by every batch
+    tile_cache = None
+    if args.tile_cache_dir:
+        if args.polygon_path:
+            LOGGER.warning(
+                'tile cache does not support polygon in/out masks, '
+                'sampling landcover fractions on GEE instead')
+        else:
+            tile_cache = ee_tile_cache.TileCache(
+                args.tile_cache_dir, int(args.tile_cache_max_gb * 2**30))
+
+    batch_args_list = []
     for index in range(math.ceil(point_table.shape[0]/args.batch_size)):
         min_index = index*args.batch_size
         max_index = (index+1)*args.batch_size
-        sample_task = task_graph.add_task(
-            func=_sample_table,
-            args=(
-                point_table, min_index, max_index, args.lat_field,
-                args.long_field, args.year_field, args.point_buffer,
-                cult_nat_raster_id_list, args.polygon_path, args.sample_scale),
-            store_result=True,
-            task_name=f'sample table on index {index}')
-
-        local_sample_keys, local_sample_list = sample_task.get()
-        sample_keys = sample_keys.union(local_sample_keys)
-        sample_list.extend(local_sample_list)
+        batch_args_list.append((
+            point_table, min_index, max_index, args.lat_field,
+            args.long_field, args.year_field, args.point_buffer,
+            args.buffer_shape, args.buffer_max_error,
+            cult_nat_raster_id_list, args.polygon_path, ee_poly, polymask,
+            inv_polymask, args.sample_scale, args.native_scale, tile_cache,
+            args.site_cache_path, reducer_list))
+
+    batch_cache, batch_key_list = None, None
+    if args.batch_cache_dir:
+        batch_cache = ee_batch_cache.BatchCache(args.batch_cache_dir)
+        batch_config = _batch_config(
+            args.lat_field, args.long_field, args.year_field,
+            args.point_buffer, args.buffer_shape, args.buffer_max_error,
+            cult_nat_raster_id_list, args.polygon_path, args.sample_scale,
+            args.native_scale, tile_cache is not None, reducer_list)
+        batch_key_list = [
+            ee_batch_cache.batch_key(
+                batch_config, point_table[min_index:max_index])
+            for _, min_index, max_index, *_ in batch_args_list]
+
+    accumulator = ee_accumulator.SampleAccumulator(point_table.index)
+    # every complete row is written, fields of years without data are
+    # invalid rather than the row being dropped
+    accumulator.mark_sampled(point_table.dropna().index)
+    asyncio.run(_run_sample_pipeline(
+        batch_args_list, accumulator, args.point_buffer, args.n_workers,
+        args.queue_size, batch_cache, batch_key_list))
 
     # take out the point table columns so we can do them first
-    sample_keys = list(sorted(sample_keys))
-    table_keys = point_table.columns
+    sample_keys = accumulator.keys()
+    table_keys = list(point_table.columns)
 
     poly_str = '_'
     if args.polygon_path:
         poly_str += 'poly_'
+    if args.buffer_shape != ee_geometry.DEFAULT_BUFFER_SHAPE:
+        poly_str += f'{args.buffer_shape.replace(":", "")}_'
+
+    point_buffer_str = '-'.join([f'{x:g}' for x in args.point_buffer])
+    table_path = f'sampled_{point_buffer_str}m_{landcover_substring}{poly_str}{os.path.basename(args.csv_path)}'
+    header_keys = table_keys
+    if args.shard:
+        table_path_for_shard = table_path
+        table_path, _ = ee_shard.shard_paths(
+            table_path_for_shard, shard_index, n_shards)
+        header_keys = [ee_shard.ROW_INDEX_FIELD] + table_keys
+    # format the input columns once per row rather than once per key
+    table_row_by_index = dict(zip(point_table.index, point_table[
+        table_keys].astype(str).itertuples(index=False, name=None)))
+    n_rows = 0
+    with open(table_path, 'w', newline='') as table_file:
+        # input values may hold commas or quotes, csv quotes them as needed
+        writer = csv.writer(table_file, lineterminator='\n')
+        writer.writerow(header_keys + sample_keys)
+        for point_index, values in accumulator.iter_rows(sample_keys):
+            row = list(table_row_by_index[point_index]) + [
+                ee_accumulator.format_value(x) for x in values]
+            if args.shard:
+                row.insert(0, point_index)
+            writer.writerow(row)
+            n_rows += 1
+    if args.shard:
+        manifest_path = ee_shard.write_manifest(
+            table_path_for_shard, shard_index, n_shards, args.shard_by,
+            table_keys, sample_keys, n_rows)
+        LOGGER.info(f'wrote shard {args.shard} manifest to {manifest_path}')
+
+
+def configure_logging():
+    """Log everything at DEBUG, only done by entry points not on import."""
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format=(
+            '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
+            ' [%(funcName)s:%(lineno)d] %(message)s'))
+    logging.getLogger('fiona').setLevel(logging.WARN)
+
 
-    table_path = f'sampled_{args.point_buffer}m_{landcover_substring}{poly_str}{os.path.basename(args.csv_path)}'
-    with open(table_path, 'w') as table_file:
-        table_file.write(
-            ','.join(table_keys) + f',{",".join(sample_keys)}\n')
-        for sample in sample_list:
-            table_file.write(
-                ','.join([str(sample[key]) for key in table_keys]) + ',')
-            table_file.write(','.join([
-                'invalid' if field not in sample else
-                str(sample[field]) for field in sample_keys]) + '\n')
+def main():
+    """Entry point."""
+    configure_logging()
+    parser = argparse.ArgumentParser(
+        description='Sample MODIS biophyisical areas on point data with additional information specified about cultivated/natural areas.')
+    add_arguments(parser)
+    run(parser.parse_args())
 
 
 if __name__ == '__main__':
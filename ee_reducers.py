@@ -0,0 +1,131 @@
+"""Build combined GEE reducers from a list of statistic names."""
+import re
+
+import ee_lazy
+
+ee = ee_lazy.lazy_import('ee')
+numpy = ee_lazy.lazy_import('numpy')
+
+DEFAULT_REDUCERS = 'mean'
+
+# these reducers map directly to an ee.Reducer with a single output of the
+# same name, percentiles are given as ``pNN``
+SIMPLE_REDUCER_LIST = [
+    'mean', 'median', 'mode', 'min', 'max', 'sum', 'count', 'stdDev',
+    'variance']
+PERCENTILE_PATTERN = re.compile(r'^p(\d{1,2}|100)$')
+
+
+def parse_reducers(reducer_str):
+    """Parse a comma separated list of statistics like ``mean,stdDev,p90``.
+
+    Percentiles are normalized to the ``p5`` form GEE names its outputs
+    with, so ``p05`` is read as ``p5``.
+
+    Raises:
+        ValueError if a statistic is unknown or repeated.
+    """
+    reducer_list = []
+    for reducer_id in [x.strip() for x in reducer_str.split(',')]:
+        if not reducer_id:
+            continue
+        percentile_match = PERCENTILE_PATTERN.match(reducer_id)
+        if percentile_match:
+            reducer_id = f'p{int(percentile_match.group(1))}'
+        elif reducer_id not in SIMPLE_REDUCER_LIST:
+            raise ValueError(
+                f'unknown reducer "{reducer_id}", expected one of '
+                f'{SIMPLE_REDUCER_LIST} or a percentile like p90')
+        reducer_list.append(reducer_id)
+    if not reducer_list:
+        raise ValueError('at least one reducer must be given')
+    if len(set(reducer_list)) != len(reducer_list):
+        raise ValueError(f'repeated reducer in "{reducer_str}"')
+    return reducer_list
+
+
+def _single_reducer(reducer_id):
+    """Return the ee.Reducer for a single statistic name."""
+    percentile_match = PERCENTILE_PATTERN.match(reducer_id)
+    if percentile_match:
+        return ee.Reducer.percentile([int(percentile_match.group(1))])
+    return getattr(ee.Reducer, reducer_id)()
+
+
+def build_reducer(reducer_list, band_name_list=None):
+    """Combine all statistics in ``reducer_list`` into one shared reducer.
+
+    All statistics are calculated over the same pixels in a single
+    ``reduceRegions`` pass.
+
+    Args:
+        reducer_list (list): statistic names from ``parse_reducers``
+        band_name_list (list): names of the bands of the reduced image in
+            order, if given outputs are named by ``output_name`` even when
+            the image has a single band, which GEE would otherwise name by
+            statistic only
+
+    Returns:
+        ee.Reducer
+    """
+    reducer = _single_reducer(reducer_list[0])
+    for reducer_id in reducer_list[1:]:
+        reducer = reducer.combine(
+            reducer2=_single_reducer(reducer_id), sharedInputs=True)
+    if band_name_list is not None:
+        # forEach uses the names as is for a single output and as a prefix
+        # of every output otherwise, as output_name does
+        reducer = reducer.forEach(band_name_list)
+    return reducer
+
+
+def output_name(band_name, reducer_id, reducer_list):
+    """Return the output field name of ``band_name`` reduced by a statistic.
+
+    A single statistic keeps the bare band name so default ``mean`` runs
+    produce the same columns as before, otherwise fields are named
+    ``{band_name}_{reducer_id}`` as GEE does for combined reducers.
+    """
+    if len(reducer_list) == 1:
+        return band_name
+    return f'{band_name}_{reducer_id}'
+
+
+def output_names(band_name_set, reducer_list):
+    """Return the set of output field names for all bands and statistics."""
+    return set(
+        output_name(band_name, reducer_id, reducer_list)
+        for band_name in band_name_set for reducer_id in reducer_list)
+
+
+def local_reduce(values, reducer_list):
+    """Calculate statistics of a numpy array the way the GEE reducers do.
+
+    Returns:
+        dict of reducer id to value, statistics of an empty array are None
+        except for ``count``
+    """
+    # masks arrive as bool arrays, which numpy.percentile cannot subtract
+    values = numpy.asarray(values, dtype=numpy.float64)
+    result = {}
+    for reducer_id in reducer_list:
+        if reducer_id == 'count':
+            result[reducer_id] = int(values.size)
+            continue
+        if values.size == 0:
+            result[reducer_id] = None
+            continue
+        percentile_match = PERCENTILE_PATTERN.match(reducer_id)
+        if percentile_match:
+            value = numpy.percentile(values, int(percentile_match.group(1)))
+        elif reducer_id == 'mode':
+            unique_values, counts = numpy.unique(values, return_counts=True)
+            value = unique_values[counts.argmax()]
+        elif reducer_id == 'stdDev':
+            value = numpy.std(values)
+        elif reducer_id == 'variance':
+            value = numpy.var(values)
+        else:
+            value = getattr(numpy, reducer_id)(values)
+        result[reducer_id] = float(value)
+    return result
@@ -1,28 +1,26 @@
 """Sample GEE datasets given pest control CSV."""
 from datetime import datetime
 import argparse
+import collections
+import concurrent.futures
+import csv
+import functools
+import math
 import os
 import json
 
-import geopandas
-import ee
-import numpy
-import pandas
+import ee_datasets
+import ee_geometry
+import ee_lazy
+import ee_reducers
+import ee_session
+import ee_shard
 
+geopandas = ee_lazy.lazy_import('geopandas')
+ee = ee_lazy.lazy_import('ee')
+numpy = ee_lazy.lazy_import('numpy')
+pandas = ee_lazy.lazy_import('pandas')
 
-REDUCER = 'mean'
-NLCD_DATASET = 'USGS/NLCD_RELEASES/2016_REL'
-NLCD_VALID_YEARS = numpy.array([
-    1992, 2001, 2004, 2006, 2008, 2011, 2013, 2016])
-NLCD_CLOSEST_YEAR_FIELD = 'NLCD-year'
-NLCD_NATURAL_FIELD = 'NLCD-natural'
-NLCD_CULTIVATED_FIELD = 'NLCD-cultivated'
-
-CORINE_DATASET = 'COPERNICUS/CORINE/V20/100m'
-CORINE_VALID_YEARS = numpy.array([1990, 2000, 2006, 2012, 2018])
-CORINE_CLOSEST_YEAR_FIELD = 'CORINE-year'
-CORINE_NATURAL_FIELD = 'CORINE-natural'
-CORINE_CULTIVATED_FIELD = 'CORINE-cultivated'
 
 POLY_IN_FIELD = 'POLY-in'
 POLY_OUT_FIELD = 'POLY-out'
@@ -32,358 +30,406 @@ PREV_YEAR_TAG = '-prev-year'
 MODIS_DATASET_NAME = 'MODIS/006/MCD12Q2'  # 500m resolution
 VALID_MODIS_RANGE = (2001, 2019)
 
+# these variables are measured in days since 1-1-1970
+MODIS_JULIAN_DAY_VARIABLES = [
+    'Greenup_1',
+    'MidGreenup_1',
+    'Peak_1',
+    'Maturity_1',
+    'MidGreendown_1',
+    'Senescence_1',
+    'Dormancy_1',
+    ]
+
+# these variables are direct quantities
+MODIS_RAW_VARIABLES = [
+    'EVI_Minimum_1',
+    'EVI_Amplitude_1',
+    'EVI_Area_1',
+    'QA_Overall_1',
+    ]
+
+# landcover datasets that mask the MODIS variables into natural/cultivated,
+# keyed by their command line flag
+RASTER_DB = {
+    'nlcd': {
+        **ee_datasets.LANDCOVER_DB[ee_datasets.NLCD_ID],
+        # masks are split into inside/outside of --polygon_path
+        'split_by_polygon': True,
+        },
+    'corine': {
+        **ee_datasets.LANDCOVER_DB[ee_datasets.CORINE_ID],
+        'split_by_polygon': False,
+        },
+}
+
+# getInfo refuses to return more features than this in one response
+MAX_FEATURES_PER_REQUEST = 5000
+# fragments of GEE errors that a smaller request may avoid
+RESPONSE_LIMIT_ERRORS = [
+    'accumulating over',
+    'payload size exceeds',
+    'memory limit exceeded',
+    'computation timed out',
+    ]
+
 
 def _get_closest_num(number_list, candidate):
     """Return closest number in sorted list."""
-    index = (numpy.abs(number_list - candidate)).argmin()
-    return int(number_list[index])
+    number_array = numpy.asarray(number_list)
+    index = (numpy.abs(number_array - candidate)).argmin()
+    return int(number_array[index])
 
 
-def _corine_natural_cultivated_mask(year):
-    """Natural: 311-423, Cultivated: 211 - 244."""
-    closest_year = _get_closest_num(CORINE_VALID_YEARS, year)
-    corine_imagecollection = ee.ImageCollection(CORINE_DATASET)
+def _modis_fields():
+    """Return the output field of every MODIS variable for the sample year."""
+    return [
+        f'{MODIS_DATASET_NAME}-{variable}'
+        for variable in MODIS_JULIAN_DAY_VARIABLES+MODIS_RAW_VARIABLES]
 
-    corine_landcover = corine_imagecollection.filter(
-        ee.Filter.eq('system:index', str(closest_year))).first().select('landcover')
 
-    natural_mask = ee.Image(0).where(
-        corine_landcover.gte(311).And(corine_landcover.lte(423)), 1)
-    natural_mask = natural_mask.rename(CORINE_NATURAL_FIELD)
+def _mask_id_list(landcover_id, poly_flag):
+    """Return the names of the natural/cultivated masks of a dataset.
 
-    cultivated_mask = ee.Image(0).where(
-        corine_landcover.gte(211).And(corine_landcover.lte(244)), 1)
-    cultivated_mask = cultivated_mask.rename(CORINE_CULTIVATED_FIELD)
-    return natural_mask, cultivated_mask, closest_year
+    Args:
+        landcover_id (str): key in ``RASTER_DB``
+        poly_flag (bool): True if a polygon is used, datasets that are
+            ``split_by_polygon`` then have an inside and outside mask of each
 
+    Returns:
+        list of mask names, also used to suffix the masked MODIS bands
+    """
+    raster = RASTER_DB[landcover_id]
+    mask_id_list = [raster['natural_field'], raster['cultivated_field']]
+    if not (poly_flag and raster['split_by_polygon']):
+        return mask_id_list
+    return [
+        f'{mask_id}-{poly_field}'
+        for poly_field in (POLY_IN_FIELD, POLY_OUT_FIELD)
+        for mask_id in mask_id_list]
 
-def _nlcd_natural_cultivated_mask(year, ee_poly):
-    """Natural for NLCD in 41-74 or 90-95."""
-    closest_year = _get_closest_num(NLCD_VALID_YEARS, year)
-    nlcd_imagecollection = ee.ImageCollection(NLCD_DATASET)
-    nlcd_year = nlcd_imagecollection.filter(
-        ee.Filter.eq('system:index', str(closest_year))).first().select('landcover')
-    # natural 41-74 & 90-95
-    natural_mask = ee.Image(0).where(
-        nlcd_year.gte(41).And(nlcd_year.lte(74)).Or(
-            nlcd_year.gte(90).And(nlcd_year.lte(95))), 1)
-    natural_mask = natural_mask.rename(NLCD_NATURAL_FIELD)
 
-    cultivated_mask = ee.Image(0).where(
-        nlcd_year.gte(81).And(nlcd_year.lte(82)), 1)
-    cultivated_mask = cultivated_mask.rename(NLCD_CULTIVATED_FIELD)
+def _header_fields(landcover_id_list, poly_flag, reducer_list):
+    """Return every sampled field in output order.
 
-    if not ee_poly:
-        return natural_mask, cultivated_mask, closest_year
+    This is the band plan shared by every batch: ``_year_band_stack`` names
+    its bands from the same ``_mask_id_list``.
 
-    # create masks of in/out using same bounds as base image
-    polymask = natural_mask.updateMask(ee.Image(1).clip(ee_poly)).unmask().gt(0)
-    inv_polymask = polymask.unmask().Not()
+    Args:
+        landcover_id_list (list): keys in ``RASTER_DB`` to mask with
+        poly_flag (bool): True if a polygon is used
+        reducer_list (list): statistics calculated for each band
 
-    natural_mask_in = natural_mask.updateMask(polymask)
-    cultivated_mask_in = cultivated_mask.updateMask(polymask)
-    #closest_year_in = closest_year.updateMask(polymask)
-    natural_mask_out = natural_mask.updateMask(inv_polymask)
-    cultivated_mask_out = cultivated_mask.updateMask(inv_polymask)
-    #closest_year_out = closest_year.updateMask(inv_polymask)
+    Returns:
+        list of field names
+    """
+    modis_fields = _modis_fields()
+    band_list = [
+        x for field in modis_fields for x in (field, field+PREV_YEAR_TAG)]
+    for landcover_id in landcover_id_list:
+        band_list += [
+            f'{field}{year_tag}-{mask_id}'
+            for field in modis_fields
+            for mask_id in _mask_id_list(landcover_id, poly_flag)
+            for year_tag in ('', PREV_YEAR_TAG)]
+    for landcover_id in landcover_id_list:
+        band_list += _mask_id_list(landcover_id, poly_flag)
+        band_list.append(RASTER_DB[landcover_id]['closest_year_field'])
+
+    # every band is reported once per statistic
+    header_fields = [
+        ee_reducers.output_name(field, reducer_id, reducer_list)
+        for field in band_list for reducer_id in reducer_list]
 
-    return (
-        natural_mask_in, cultivated_mask_in,
-        natural_mask_out, cultivated_mask_out, closest_year)
+    if poly_flag:
+        header_fields.append(POLY_IN_FIELD)
+        header_fields.append(POLY_OUT_FIELD)
+    return header_fields
 
 
-def _sample_pheno(pts_by_year, nlcd_flag, corine_flag, ee_poly):
-    """Sample phenology variables from https://docs.google.com/spreadsheets/d/1nbmCKwIG29PF6Un3vN6mQGgFSWG_vhB6eky7wVqVwPo
+def _landcover_masks(landcover_id, year, polymask, inv_polymask):
+    """Build the natural/cultivated masks of a dataset for a year.
 
     Args:
-        pts_by_year:
-        nlcd_flag (bool): if True, sample the NLCD dataset
-        corine_flag (bool): if True, sample the CORINE dataset
-        ee_poly (ee.Polygon): if not None, additionally filter samples on the
-            nlcd/corine datasets to see what's in or out.
+        landcover_id (str): key in ``RASTER_DB``
+        year (int): year to sample, the closest valid year is used
+        polymask (ee.Image): 0/1 image that is 1 inside the polygon or None
+        inv_polymask (ee.Image): 0/1 image that is 1 outside the polygon or
+            None
 
     Returns:
-        header_fields (list):
-
+        closest year,
+        list of (mask name, 0/1 mask image) in ``_mask_id_list`` order
     """
-    # these variables are measured in days since 1-1-1970
-    julian_day_variables = [
-        'Greenup_1',
-        'MidGreenup_1',
-        'Peak_1',
-        'Maturity_1',
-        'MidGreendown_1',
-        'Senescence_1',
-        'Dormancy_1',
-        ]
-
-    # these variables are direct quantities
-    raw_variables = [
-        'EVI_Minimum_1',
-        'EVI_Amplitude_1',
-        'EVI_Area_1',
-        'QA_Overall_1',
-        ]
-
+    raster = RASTER_DB[landcover_id]
+    closest_year = _get_closest_num(raster['valid_years'], year)
+    landcover = ee.ImageCollection(raster['asset_id']).filter(
+        ee.Filter.eq('system:index', str(closest_year))).first().select(
+        'landcover')
+
+    mask_list = []
+    for id_list in [raster['natural_id_list'], raster['cultivated_id_list']]:
+        in_range = functools.reduce(
+            lambda x, y: x.Or(y), [
+                landcover.gte(low_id).And(landcover.lte(high_id))
+                for low_id, high_id in id_list])
+        mask_list.append(ee.Image(0).where(in_range, 1))
+    if polymask is not None and raster['split_by_polygon']:
+        mask_list = [
+            mask.updateMask(poly_mask)
+            for poly_mask in (polymask, inv_polymask)
+            for mask in mask_list]
+    mask_id_list = _mask_id_list(landcover_id, polymask is not None)
+    return closest_year, [
+        (mask_id, mask.rename(mask_id))
+        for mask_id, mask in zip(mask_id_list, mask_list)]
+
+
+def _modis_bands(active_year, year_tag):
+    """Return the MODIS variables of a year as one image or None.
+
+    Julian day variables are converted to days since the start of
+    ``active_year`` and bands are named ``_modis_fields`` + ``year_tag``.
+    """
+    if not VALID_MODIS_RANGE[0] <= active_year <= VALID_MODIS_RANGE[1]:
+        return None
     epoch_date = datetime.strptime('1970-01-01', "%Y-%m-%d")
-    modis_phen = ee.ImageCollection(MODIS_DATASET_NAME)
+    current_year = datetime.strptime(f'{active_year}-01-01', "%Y-%m-%d")
+    days_since_epoch = (current_year - epoch_date).days
+    modis_phen = ee.ImageCollection(MODIS_DATASET_NAME).filterDate(
+        f'{active_year}-01-01', f'{active_year}-12-31')
+    band_names = [field+year_tag for field in _modis_fields()]
 
-    header_fields = [
-        f'{MODIS_DATASET_NAME}-{field}'
-        for field in julian_day_variables+raw_variables]
-
-    header_fields_with_prev_year = [
-        x for field in header_fields for x in (field, field+PREV_YEAR_TAG)]
-
-    if nlcd_flag:
-        header_fields_with_prev_year += [
-            x for field in header_fields
-            for x in (
-                field+'-'+NLCD_NATURAL_FIELD,
-                field+PREV_YEAR_TAG+'-'+NLCD_NATURAL_FIELD,
-                field+'-'+NLCD_CULTIVATED_FIELD,
-                field+PREV_YEAR_TAG+'-'+NLCD_CULTIVATED_FIELD)]
-
-    if corine_flag:
-        header_fields_with_prev_year += [
-            x for field in header_fields
-            for x in (
-                field+'-'+CORINE_NATURAL_FIELD,
-                field+PREV_YEAR_TAG+'-'+CORINE_NATURAL_FIELD,
-                field+'-'+CORINE_CULTIVATED_FIELD,
-                field+PREV_YEAR_TAG+'-'+CORINE_CULTIVATED_FIELD)]
-
-    if nlcd_flag:
-        if ee_poly:
-            header_fields_with_prev_year.append(
-                f'{NLCD_NATURAL_FIELD}-{POLY_IN_FIELD}')
-            header_fields_with_prev_year.append(
-                f'{NLCD_CULTIVATED_FIELD}-{POLY_IN_FIELD}')
-            header_fields_with_prev_year.append(
-                f'{NLCD_NATURAL_FIELD}-{POLY_OUT_FIELD}')
-            header_fields_with_prev_year.append(
-                f'{NLCD_CULTIVATED_FIELD}-{POLY_OUT_FIELD}')
-        else:
-            header_fields_with_prev_year.append(NLCD_NATURAL_FIELD)
-            header_fields_with_prev_year.append(NLCD_CULTIVATED_FIELD)
-        header_fields_with_prev_year.append(NLCD_CLOSEST_YEAR_FIELD)
-
-    if corine_flag:
-        header_fields_with_prev_year.append(CORINE_NATURAL_FIELD)
-        header_fields_with_prev_year.append(CORINE_CULTIVATED_FIELD)
-        header_fields_with_prev_year.append(CORINE_CLOSEST_YEAR_FIELD)
+    julian_day_bands = modis_phen.select(
+        MODIS_JULIAN_DAY_VARIABLES).toBands().subtract(days_since_epoch)
+    raw_variable_bands = modis_phen.select(MODIS_RAW_VARIABLES).toBands()
+    return julian_day_bands.addBands(raw_variable_bands).rename(band_names)
 
-    if ee_poly:
-        header_fields_with_prev_year.append(POLY_IN_FIELD)
-        header_fields_with_prev_year.append(POLY_OUT_FIELD)
 
-    sample_list = []
-    for year in pts_by_year.keys():
-        print(f'processing year {year}')
-        year_points = pts_by_year[year]
-        all_bands = None
-
-        if nlcd_flag:
-            if not ee_poly:
-                nlcd_natural_mask, nlcd_cultivated_mask, nlcd_closest_year = \
-                    _nlcd_natural_cultivated_mask(year, None)
-            else:
-                (nlcd_natural_mask_poly_in, nlcd_cultivated_mask_poly_in,
-                 nlcd_natural_mask_poly_out, nlcd_cultivated_mask_poly_out,
-                 nlcd_closest_year) = \
-                    _nlcd_natural_cultivated_mask(year, ee_poly)
-            print(f'nlcd_closest_year: {nlcd_closest_year}')
-
-        if corine_flag:
-            corine_natural_mask, corine_cultivated_mask, corine_closest_year = \
-                _corine_natural_cultivated_mask(year)
-
-        for active_year, band_name_suffix in (
-                (year, ''), (year-1, PREV_YEAR_TAG)):
-            if VALID_MODIS_RANGE[0] <= active_year <= VALID_MODIS_RANGE[1]:
-                print(f'modis active_year: {active_year}')
-                current_year = datetime.strptime(
-                    f'{active_year}-01-01', "%Y-%m-%d")
-                days_since_epoch = (current_year - epoch_date).days
-                modis_band_names = [
-                    x+band_name_suffix
-                    for x in header_fields[0:len(julian_day_variables)]]
-                bands_since_1970 = modis_phen.select(
-                    julian_day_variables).filterDate(
-                    f'{active_year}-01-01', f'{active_year}-12-31')
-                julian_day_bands = (
-                    bands_since_1970.toBands()).subtract(days_since_epoch)
-                julian_day_bands = julian_day_bands.rename(modis_band_names)
-                raw_band_names = [
-                    x+band_name_suffix
-                    for x in header_fields[len(julian_day_variables)::]]
-                raw_variable_bands = modis_phen.select(
-                    raw_variables).filterDate(
-                    f'{active_year}-01-01', f'{active_year}-12-31').toBands()
-                raw_variable_bands = raw_variable_bands.rename(raw_band_names)
-
-                local_band_stack = julian_day_bands.addBands(raw_variable_bands)
-                all_band_names = modis_band_names+raw_band_names
-
-                if all_bands is None:
-                    all_bands = local_band_stack
-                else:
-                    all_bands = all_bands.addBands(local_band_stack)
-
-            # mask raw variable bands by cultivated/natural
-            if nlcd_flag:
-                if not ee_poly:
-                    nlcd_cultivated_variable_bands = local_band_stack.updateMask(
-                        nlcd_cultivated_mask)
-                    nlcd_cultivated_variable_bands = \
-                        nlcd_cultivated_variable_bands.rename([
-                            band_name+'-'+NLCD_CULTIVATED_FIELD
-                            for band_name in all_band_names])
-
-                    nlcd_natural_variable_bands = local_band_stack.updateMask(
-                        nlcd_natural_mask)
-                    nlcd_natural_variable_bands = nlcd_natural_variable_bands.rename([
-                        band_name+'-'+NLCD_NATURAL_FIELD
-                        for band_name in all_band_names])
-                    nlcd_closest_year_image = ee.Image(
-                        int(nlcd_closest_year)).rename(NLCD_CLOSEST_YEAR_FIELD)
-                    if all_bands is None:
-                        all_bands = nlcd_natural_variable_bands
-                    else:
-                        all_bands = all_bands.addBands(
-                            nlcd_natural_variable_bands)
-                    all_bands = all_bands.addBands(nlcd_cultivated_variable_bands)
-                    all_bands = all_bands.addBands(nlcd_natural_mask)
-                    all_bands = all_bands.addBands(nlcd_cultivated_mask)
-                    all_bands = all_bands.addBands(nlcd_closest_year_image)
-                else:
-                    nlcd_cultivated_variable_bands_poly_in = local_band_stack.updateMask(
-                        nlcd_cultivated_mask_poly_in)
-                    nlcd_cultivated_variable_bands_poly_in = \
-                        nlcd_cultivated_variable_bands_poly_in.rename([
-                            f'{band_name}-{NLCD_CULTIVATED_FIELD}-{POLY_IN_FIELD}'
-                            for band_name in all_band_names])
-
-                    nlcd_natural_variable_bands_poly_in = local_band_stack.updateMask(
-                        nlcd_natural_mask_poly_in)
-                    nlcd_natural_variable_bands_poly_in = nlcd_natural_variable_bands_poly_in.rename([
-                        f'{band_name}-{NLCD_NATURAL_FIELD}-{POLY_IN_FIELD}'
-                        for band_name in all_band_names])
-                    nlcd_closest_year_image = ee.Image(
-                        int(nlcd_closest_year)).rename(NLCD_CLOSEST_YEAR_FIELD)
-                    if all_bands is None:
-                        all_bands = nlcd_cultivated_variable_bands_poly_in
-                    else:
-                        all_bands = all_bands.addBands(
-                            nlcd_natural_variable_bands_poly_in)
-                    all_bands = all_bands.addBands(nlcd_cultivated_variable_bands_poly_in)
-                    all_bands = all_bands.addBands(nlcd_natural_mask_poly_in)
-                    all_bands = all_bands.addBands(nlcd_cultivated_mask_poly_in)
-
-                    nlcd_cultivated_variable_bands_poly_out = local_band_stack.updateMask(
-                        nlcd_cultivated_mask_poly_out)
-                    nlcd_cultivated_variable_bands_poly_out = \
-                        nlcd_cultivated_variable_bands_poly_out.rename([
-                            f'{band_name}-{NLCD_CULTIVATED_FIELD}-{POLY_OUT_FIELD}'
-                            for band_name in all_band_names])
-
-                    nlcd_natural_variable_bands_poly_out = local_band_stack.updateMask(
-                        nlcd_natural_mask_poly_out)
-                    nlcd_natural_variable_bands_poly_out = nlcd_natural_variable_bands_poly_out.rename([
-                        f'{band_name}-{NLCD_NATURAL_FIELD}-{POLY_OUT_FIELD}'
-                        for band_name in all_band_names])
-                    nlcd_closest_year_image = ee.Image(
-                        int(nlcd_closest_year)).rename(NLCD_CLOSEST_YEAR_FIELD)
-                    all_bands = all_bands.addBands(nlcd_natural_variable_bands_poly_out)
-                    all_bands = all_bands.addBands(nlcd_cultivated_variable_bands_poly_out)
-                    all_bands = all_bands.addBands(nlcd_natural_mask_poly_out)
-                    all_bands = all_bands.addBands(nlcd_cultivated_mask_poly_out)
-
-                    all_bands = all_bands.addBands(nlcd_closest_year_image)
-
-            if corine_flag:
-                corine_cultivated_variable_bands = \
-                    local_band_stack.updateMask(corine_cultivated_mask.eq(1))
-                corine_cultivated_variable_bands = \
-                    corine_cultivated_variable_bands.rename([
-                        band_name+'-'+CORINE_CULTIVATED_FIELD
-                        for band_name in all_band_names])
-
-                corine_natural_variable_bands = local_band_stack.updateMask(
-                    corine_natural_mask.eq(1))
-                corine_natural_variable_bands = \
-                    corine_natural_variable_bands.rename([
-                        band_name+'-'+CORINE_NATURAL_FIELD
-                        for band_name in all_band_names])
-                corine_closest_year_image = ee.Image(
-                    int(corine_closest_year)).rename(
-                    CORINE_CLOSEST_YEAR_FIELD)
-                if all_bands is None:
-                    all_bands = corine_cultivated_variable_bands
-                else:
-                    all_bands = all_bands.addBands(
-                        corine_cultivated_variable_bands)
-                all_bands = all_bands.addBands(corine_natural_variable_bands)
-                all_bands = all_bands.addBands(corine_natural_mask)
-                all_bands = all_bands.addBands(corine_cultivated_mask)
-                all_bands = all_bands.addBands(corine_closest_year_image)
-
-        print('reduce regions')
-
-        # determine area in/out of point area
-        if ee_poly:
-            def area_in_out(feature):
-                feature_area = feature.area()
-                area_in = ee_poly.intersection(feature.geometry()).area()
-                return feature.set({
-                    POLY_OUT_FIELD: feature_area.subtract(area_in),
-                    POLY_IN_FIELD: area_in})
-
-            year_points = year_points.map(area_in_out).getInfo()
-
-        samples = all_bands.reduceRegions(**{
-            'collection': year_points,
-            'reducer': REDUCER}).getInfo()
-        sample_list.extend(samples['features'])
-
-    return header_fields_with_prev_year, sample_list
+def _year_band_stack(year, landcover_id_list, polymask, inv_polymask):
+    """Build the image of every band sampled for points of ``year``.
 
+    MODIS variables of ``year`` and the year before are stacked as is and
+    once per landcover mask, then the masks and closest landcover years
+    are added once.
 
-def main():
-    """Entry point."""
-    parser = argparse.ArgumentParser(
-        description='sample points on GEE data')
+    Returns:
+        ee.Image with bands named as in ``_header_fields`` or None if there
+        is nothing to sample for ``year``
+    """
+    masks_by_landcover = {
+        landcover_id: _landcover_masks(
+            landcover_id, year, polymask, inv_polymask)
+        for landcover_id in landcover_id_list}
+
+    band_list = []
+    for active_year, year_tag in ((year, ''), (year-1, PREV_YEAR_TAG)):
+        modis_bands = _modis_bands(active_year, year_tag)
+        if modis_bands is None:
+            continue
+        band_list.append(modis_bands)
+        band_names = [field+year_tag for field in _modis_fields()]
+        for landcover_id in landcover_id_list:
+            _, mask_list = masks_by_landcover[landcover_id]
+            band_list.extend(
+                modis_bands.updateMask(mask).rename([
+                    f'{band_name}-{mask_id}' for band_name in band_names])
+                for mask_id, mask in mask_list)
+
+    for landcover_id in landcover_id_list:
+        closest_year, mask_list = masks_by_landcover[landcover_id]
+        band_list.extend(mask for _, mask in mask_list)
+        band_list.append(ee.Image(int(closest_year)).rename(
+            RASTER_DB[landcover_id]['closest_year_field']))
+
+    if not band_list:
+        return None
+    return functools.reduce(lambda x, y: x.addBands(y), band_list)
+
+
+def _poly_area_in_out(ee_poly):
+    """Return a feature map function that sets its area in/out of a poly."""
+    def area_in_out(feature):
+        """Set ``POLY_IN_FIELD``/``POLY_OUT_FIELD`` areas in m^2."""
+        feature_area = feature.area()
+        area_in = ee_poly.intersection(feature.geometry()).area()
+        return feature.set({
+            POLY_OUT_FIELD: feature_area.subtract(area_in),
+            POLY_IN_FIELD: area_in})
+    return area_in_out
+
+
+def _reduce_features(
+        band_stack, feature_list, reducer, sample_scale, ee_poly):
+    """Sample ``band_stack`` under every feature in as few requests as fit.
+
+    Features are sent at most ``MAX_FEATURES_PER_REQUEST`` at a time, and a
+    page that GEE rejects for its size or run time is split in half and
+    retried until it fits.
+
+    Args:
+        band_stack (ee.Image): bands to reduce or None to only get the
+            polygon areas
+        feature_list (list): ``ee.Feature`` buffers to sample
+        reducer (ee.Reducer): reducer applied to every band
+        sample_scale (float): scale to sample rasters in meters
+        ee_poly (ee.Geometry): polygon for in/out areas or None
+
+    Returns:
+        list of properties dicts, one per feature
+    """
+    if len(feature_list) > MAX_FEATURES_PER_REQUEST:
+        page_size = MAX_FEATURES_PER_REQUEST
+        return [
+            properties
+            for page_index in range(0, len(feature_list), page_size)
+            for properties in _reduce_features(
+                band_stack, feature_list[page_index:page_index+page_size],
+                reducer, sample_scale, ee_poly)]
+
+    collection = ee.FeatureCollection(feature_list)
+    if ee_poly:
+        collection = collection.map(_poly_area_in_out(ee_poly))
+    if band_stack is not None:
+        collection = band_stack.reduceRegions(**{
+            'collection': collection,
+            'reducer': reducer,
+            'scale': sample_scale,
+            })
+    try:
+        return [
+            feature['properties']
+            for feature in collection.getInfo()['features']]
+    except ee.EEException as e:
+        if len(feature_list) == 1 or not any(
+                limit_error in str(e).lower()
+                for limit_error in RESPONSE_LIMIT_ERRORS):
+            raise
+        print(f'splitting {len(feature_list)} features after: {e}')
+        half = len(feature_list) // 2
+        return (
+            _reduce_features(
+                band_stack, feature_list[:half], reducer, sample_scale,
+                ee_poly) +
+            _reduce_features(
+                band_stack, feature_list[half:], reducer, sample_scale,
+                ee_poly))
+
+
+def _sample_batch(
+        batch_table, lat_field, long_field, year_field, point_buffer,
+        buffer_shape, buffer_max_error, landcover_id_list, ee_poly, polymask,
+        inv_polymask, sample_scale, reducer_list):
+    """Sample phenology variables from https://docs.google.com/spreadsheets/d/1nbmCKwIG29PF6Un3vN6mQGgFSWG_vhB6eky7wVqVwPo
+
+    Args:
+        batch_table (pandas.Dataframe): rows to sample
+        lat_field (str): fieldname for lat in ``batch_table``
+        long_field (str): fieldname for long in ``batch_table``
+        year_field (str): fieldname for year in ``batch_table``
+        point_buffer (float): distance in m to buffer points
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N``
+        buffer_max_error (float): maximum error in m of circle buffers or
+            None
+        landcover_id_list (list): keys in ``RASTER_DB`` to mask with
+        ee_poly (ee.Geometry): if not None, additionally filter samples on
+            the landcover datasets to see what's in or out.
+        polymask (ee.Image): 0/1 mask inside ``ee_poly`` or None
+        inv_polymask (ee.Image): 0/1 mask outside ``ee_poly`` or None
+        sample_scale (float): scale to sample rasters in meters
+        reducer_list (list): statistics to calculate for each band in a
+            single pass
+
+    Returns:
+        list of properties dicts of every row in ``batch_table`` with no
+        missing values, in ``ee_shard.ROW_INDEX_FIELD`` order
+    """
+    ee_session.get_session()
+    reducer = ee_reducers.build_reducer(reducer_list)
+    sample_list = []
+    for year in batch_table[year_field].unique():
+        band_stack = _year_band_stack(
+            year, landcover_id_list, polymask, inv_polymask)
+        feature_list = [
+            ee.Feature(
+                ee_geometry.buffer_geometry(
+                    row[long_field], row[lat_field], point_buffer,
+                    buffer_shape, buffer_max_error),
+                {**row.to_dict(), ee_shard.ROW_INDEX_FIELD: int(index)})
+            for index, row in batch_table[
+                batch_table[year_field] == year].dropna().iterrows()]
+        if not feature_list:
+            continue
+        sample_list.extend(_reduce_features(
+            band_stack, feature_list, reducer, sample_scale, ee_poly))
+    return sorted(
+        sample_list, key=lambda sample: sample[ee_shard.ROW_INDEX_FIELD])
+
+
+def _format_sample(value):
+    """Format a sampled value for the csv, missing values are invalid."""
+    if value is None:
+        return 'invalid'
+    return str(value)
+
+
+def add_arguments(parser):
+    """Add the phenology sampling options to ``parser``."""
     parser.add_argument('csv_path', help='path to CSV data table')
     parser.add_argument('--year_field', default='crop_year', help='field name in csv_path for year, default `year_field`')
     parser.add_argument('--long_field', default='field_longitude', help='field name in csv_path for longitude, default `long_field`')
     parser.add_argument('--lat_field', default='field_latitude', help='field name in csv_path for latitude, default `lat_field')
     parser.add_argument('--buffer', type=float, default=1000, help='buffer distance in meters around point to do aggregate analysis, default 1000m')
+    parser.add_argument('--buffer_shape', default=ee_geometry.DEFAULT_BUFFER_SHAPE, help='shape of the buffer around each point, one of circle, square or polygon:N for a regular N sided polygon. Buffers are sent to GEE as a few explicit vertices, squares and polygons have the same area as the circle, defaults to circle')
+    parser.add_argument('--buffer_max_error', type=float, help='maximum distance in meters between a circle buffer and the polygon approximating it, defaults to 1%% of the buffer distance like GEE')
     parser.add_argument('--nlcd', default=False, action='store_true', help='use NCLD landcover for cultivated/natural masks')
     parser.add_argument('--corine', default=False, action='store_true', help='use CORINE landcover for cultivated/natural masks')
     parser.add_argument('--polygon_path', type=str, help='path to local polygon to sample')
+    parser.add_argument('--reducers', default=ee_reducers.DEFAULT_REDUCERS, help='comma separated statistics to calculate in one pass, any of mean, median, mode, min, max, sum, count, stdDev, variance or a percentile like p90, defaults to mean. With more than one statistic output columns are named {band}_{statistic}')
+    parser.add_argument('--sample_scale', type=float, default=500.0, help='scale to sample rasters in meters, defaults to 500m, the MODIS resolution')
+    parser.add_argument('--n_rows', type=int, help='limit the number of points read from the CSV to this value, useful for debugging, defaults to every row')
+    parser.add_argument('--batch_size', type=int, default=500, help='number of points sampled together, batches are written to the table in order as they finish, defaults to 500')
+    parser.add_argument('--n_workers', type=int, default=4, help='number of batches sampled on GEE at once, defaults to 4')
 
     # 2) the natural habitat eo characteristics in and out of polygon
     # 3) proportion of area outside of polygon
 
+    parser.add_argument('--shard', type=str, help='only sample shard K of N of the table, given as K/N, and write a shard table and manifest that `python ee_shard.py merge` combines once every shard is done')
+    parser.add_argument('--shard_by', default='row', choices=ee_shard.SHARD_BY_OPTIONS, help='assign rows to shards by a hash of each row, or of the spatial tile it is in so nearby points share a shard, defaults to row')
     parser.add_argument('--authenticate', action='store_true', help='Pass this flag if you need to reauthenticate with GEE')
-    args = parser.parse_args()
+
+
+def run(args):
+    """Sample MODIS phenology at the points of ``args.csv_path``."""
+    reducer_list = ee_reducers.parse_reducers(args.reducers)
+    ee_geometry.parse_buffer_shape(args.buffer_shape)
+    shard_index, n_shards = None, None
+    if args.shard:
+        shard_index, n_shards = ee_shard.parse_shard_spec(args.shard)
     if not any([args.nlcd, args.corine]):
         raise ValueError('must select at least --nlcd or --corine LULC datasets')
 
-    landcover_options = [x for x in ['nlcd', 'corine'] if vars(args)[x]]
-    landcover_substring = '_'.join(landcover_options)
+    landcover_id_list = [x for x in RASTER_DB if vars(args)[x]]
+    landcover_substring = '_'.join(landcover_id_list)
+    if args.buffer_shape != ee_geometry.DEFAULT_BUFFER_SHAPE:
+        landcover_substring += f'_{args.buffer_shape.replace(":", "")}'
     if args.authenticate:
         ee.Authenticate()
-    ee.Initialize()
+    ee_session.get_session()
     table = pandas.read_csv(
         args.csv_path, converters={
             args.long_field: lambda x: float(x),
             args.lat_field: lambda x: float(x),
             args.year_field: lambda x: int(x),
         },
-        nrows=10)
-
-    ee_poly = None
+        nrows=args.n_rows)
+    if args.shard:
+        table = table[ee_shard.shard_mask(
+            table, args.lat_field, args.long_field, args.year_field,
+            shard_index, n_shards, args.shard_by)]
+        print(f'sampling {table.shape[0]} rows in shard {args.shard}')
+
+    ee_poly, polymask, inv_polymask = None, None, None
     if args.polygon_path:
         # convert to GEE polygon
         gp_poly = geopandas.read_file(args.polygon_path).to_crs('EPSG:4326')
@@ -392,31 +438,71 @@ def main():
         for json_feature in json_poly['features']:
             coords.append(json_feature['geometry']['coordinates'])
         ee_poly = ee.Geometry.MultiPolygon(coords)
+        polymask = ee.Image(0).paint(ee_poly, 1)
+        inv_polymask = polymask.Not()
+
+    header_fields = _header_fields(
+        landcover_id_list, ee_poly is not None, reducer_list)
+
+    table_path = f'sampled_{args.buffer}m_{landcover_substring}_{os.path.basename(args.csv_path)}'
+    table_keys = list(table.columns)
+    if args.shard:
+        table_path_for_shard = table_path
+        table_path, _ = ee_shard.shard_paths(
+            table_path_for_shard, shard_index, n_shards)
+        table_keys = [ee_shard.ROW_INDEX_FIELD] + table_keys
+
+    n_batches = math.ceil(table.shape[0] / args.batch_size)
+    sample_batch = functools.partial(
+        _sample_batch, lat_field=args.lat_field, long_field=args.long_field,
+        year_field=args.year_field, point_buffer=args.buffer,
+        buffer_shape=args.buffer_shape,
+        buffer_max_error=args.buffer_max_error,
+        landcover_id_list=landcover_id_list, ee_poly=ee_poly,
+        polymask=polymask, inv_polymask=inv_polymask,
+        sample_scale=args.sample_scale, reducer_list=reducer_list)
+    n_rows = 0
+    with open(table_path, 'w', newline='') as table_file, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.n_workers) as executor:
+        # input values may hold commas or quotes, csv quotes them as needed
+        writer = csv.writer(table_file, lineterminator='\n')
+        writer.writerow(table_keys + header_fields)
+        # batches are consecutive slices of the table written in order, only
+        # a window of them is submitted at once so finished batches waiting
+        # on a slow earlier one never pile up in memory
+        window_size = 2 * args.n_workers
+        future_queue = collections.deque()
+        for batch_index in range(n_batches):
+            while len(future_queue) < window_size and (
+                    batch_index + len(future_queue) < n_batches):
+                next_index = batch_index + len(future_queue)
+                future_queue.append(executor.submit(
+                    sample_batch, table[
+                        next_index*args.batch_size:
+                        (next_index+1)*args.batch_size]))
+            sample_list = future_queue.popleft().result()
+            writer.writerows(
+                [str(sample[key]) for key in table_keys] + [
+                    _format_sample(sample.get(field))
+                    for field in header_fields]
+                for sample in sample_list)
+            table_file.flush()
+            n_rows += len(sample_list)
+            print(f'sampled batch {batch_index+1} of {n_batches}')
+    if args.shard:
+        manifest_path = ee_shard.write_manifest(
+            table_path_for_shard, shard_index, n_shards, args.shard_by,
+            list(table.columns), header_fields, n_rows)
+        print(f'wrote shard {args.shard} manifest to {manifest_path}')
 
-    pts_by_year = {}
-    for year in table[args.year_field].unique():
-        pts_by_year[year] = ee.FeatureCollection([
-            ee.Feature(
-                ee.Geometry.Point(row[args.long_field], row[args.lat_field]).buffer(args.buffer),
-                row.to_dict())
-            for index, row in table[
-                table[args.year_field] == year].dropna().iterrows()])
-
-    print('calculating pheno variables')
-    header_fields, sample_list = _sample_pheno(
-        pts_by_year, args.nlcd, args.corine, ee_poly)
-
-    with open(f'sampled_{args.buffer}m_{landcover_substring}_{os.path.basename(args.csv_path)}', 'w') as table_file:
-        table_file.write(
-            ','.join(table.columns) + f',{",".join(header_fields)}\n')
-        for sample in sample_list:
-            table_file.write(','.join([
-                str(sample['properties'][key])
-                for key in table.columns]) + ',')
-            table_file.write(','.join([
-                'invalid' if field not in sample['properties']
-                else str(sample['properties'][field])
-                for field in header_fields]) + '\n')
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='sample points on GEE data')
+    add_arguments(parser)
+    run(parser.parse_args())
 
 
 if __name__ == '__main__':
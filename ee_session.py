@@ -0,0 +1,68 @@
+"""Reuse one initialized Earth Engine session per worker process."""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+
+import ee_lazy
+
+ee = ee_lazy.lazy_import('ee')
+
+LOGGER = logging.getLogger(__name__)
+
+_SESSION_LOCK = threading.Lock()
+_SESSION = None
+
+
+class EESession(object):
+    """Credentials of an initialized ``ee`` client.
+
+    ``ee`` keeps its client in module state, so a session belongs to a
+    process and is shared by all of its threads. ``ee``'s default
+    transport is thread safe, keeps its connections open between requests
+    and refreshes expired tokens itself.
+    """
+
+    def __init__(self):
+        """Load persistent credentials and initialize ``ee`` with them."""
+        self.pid = os.getpid()
+        self.credentials = ee.data.get_persistent_credentials()
+        ee.Initialize(self.credentials)
+        LOGGER.debug(f'initialized ee session in process {self.pid}')
+
+
+def get_session():
+    """Return this process' session, initializing ``ee`` on first use.
+
+    Safe to call before every request, after the first call it only
+    returns the existing session. A forked child process gets a fresh
+    session rather than the parent's.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION.pid != os.getpid():
+            _SESSION = EESession()
+        return _SESSION
+
+
+def worker_initializer():
+    """Initializer for worker pools so sessions are ready before tasks."""
+    get_session()
+
+
+def fork_process_pool(n_workers):
+    """Return a process pool whose workers are forked from this process.
+
+    Forked workers start with every module and table the parent already
+    loaded rather than paying the import time again, and each initializes
+    its own session. Where fork is not available the platform's default
+    start method is used.
+    """
+    try:
+        mp_context = multiprocessing.get_context('fork')
+    except ValueError:
+        mp_context = None
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=mp_context,
+        initializer=worker_initializer)
@@ -0,0 +1,232 @@
+"""Split sample runs into deterministic shards and merge their outputs."""
+import argparse
+import csv
+import heapq
+import json
+import math
+import os
+import zlib
+
+ROW_INDEX_FIELD = 'row-index'
+SHARD_BY_OPTIONS = ['row', 'tile']
+# side length of the spatial tiles used by ``--shard_by tile``
+SHARD_TILE_DEGREES = 1.0
+INVALID_VALUE = 'invalid'
+
+
+def parse_shard_spec(shard_spec):
+    """Parse a ``K/N`` shard spec into (K, N) with 1 <= K <= N.
+
+    Raises:
+        ValueError if ``shard_spec`` is not of the form ``K/N``.
+    """
+    try:
+        shard_index, n_shards = [int(x) for x in shard_spec.split('/')]
+    except ValueError:
+        raise ValueError(
+            f'shard spec "{shard_spec}" is not of the form K/N, e.g. 1/4')
+    if not 1 <= shard_index <= n_shards:
+        raise ValueError(
+            f'shard spec "{shard_spec}" must have 1 <= K <= N')
+    return shard_index, n_shards
+
+
+def _shard_hash(key_str, n_shards):
+    """Return a shard index in 1..N that is stable across runs/machines."""
+    return zlib.crc32(key_str.encode('utf-8')) % n_shards + 1
+
+
+def shard_mask(
+        point_table, lat_field, long_field, year_field, shard_index,
+        n_shards, shard_by):
+    """Select the rows of ``point_table`` that belong to a shard.
+
+    Args:
+        point_table (pandas.Dataframe): table with lat/lng and year fields
+        lat_field (str): fieldname for lat in ``table``
+        long_field (str): fieldname for long in ``table``
+        year_field (str): fieldname for year in ``table``
+        shard_index (int): shard to select in 1..``n_shards``
+        n_shards (int): total number of shards
+        shard_by (str): 'row' to hash each row's location and year or
+            'tile' to hash the ``SHARD_TILE_DEGREES`` tile it falls in so
+            nearby points are sampled together
+
+    Returns:
+        list of bool, True for the rows in the shard
+    """
+    if shard_by not in SHARD_BY_OPTIONS:
+        raise ValueError(
+            f'shard_by must be one of {SHARD_BY_OPTIONS}, got "{shard_by}"')
+    mask = []
+    for lon, lat, year in zip(
+            point_table[long_field], point_table[lat_field],
+            point_table[year_field]):
+        if shard_by == 'row':
+            # fixed formatting keeps the hash stable across library versions
+            key_str = f'{float(lon):.7f},{float(lat):.7f},{int(year)}'
+        else:
+            key_str = (
+                f'{math.floor(lon / SHARD_TILE_DEGREES)},'
+                f'{math.floor(lat / SHARD_TILE_DEGREES)}')
+        mask.append(_shard_hash(key_str, n_shards) == shard_index)
+    return mask
+
+
+def shard_paths(table_path, shard_index, n_shards):
+    """Return the (csv path, manifest path) of one shard of ``table_path``."""
+    base_path = f'{table_path}.shard-{shard_index}-of-{n_shards}'
+    return f'{base_path}.csv', f'{base_path}.manifest.json'
+
+
+def write_manifest(
+        table_path, shard_index, n_shards, shard_by, table_column_list,
+        sample_column_list, n_rows):
+    """Record that a shard csv of ``table_path`` is completely written.
+
+    The manifest is written last so its existence means the shard is done.
+
+    Args:
+        table_path (str): path of the merged table the shard belongs to
+        shard_index (int): shard written in 1..``n_shards``
+        n_shards (int): total number of shards
+        shard_by (str): how rows were assigned to shards
+        table_column_list (list): columns copied from the input table,
+            without ``ROW_INDEX_FIELD``
+        sample_column_list (list): sampled columns after the table columns
+        n_rows (int): number of rows in the shard csv
+
+    Returns:
+        path to the manifest
+    """
+    shard_csv_path, manifest_path = shard_paths(
+        table_path, shard_index, n_shards)
+    manifest = {
+        'table_path': table_path,
+        'shard_csv_path': os.path.basename(shard_csv_path),
+        'shard_index': shard_index,
+        'n_shards': n_shards,
+        'shard_by': shard_by,
+        'table_columns': table_column_list,
+        'sample_columns': sample_column_list,
+        'n_rows': n_rows,
+    }
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest_path
+
+
+def _load_manifests(manifest_path_list):
+    """Load manifests and check they make up one complete set of shards."""
+    manifest_list = []
+    for manifest_path in manifest_path_list:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest['shard_csv_path'] = os.path.join(
+            os.path.dirname(manifest_path), manifest['shard_csv_path'])
+        manifest_list.append(manifest)
+    if not manifest_list:
+        raise ValueError('no shard manifests given')
+
+    first = manifest_list[0]
+    for manifest in manifest_list:
+        for key in ['table_path', 'n_shards', 'shard_by']:
+            if manifest[key] != first[key]:
+                raise ValueError(
+                    f'shard {manifest["shard_index"]} has {key} '
+                    f'{manifest[key]} but shard {first["shard_index"]} has '
+                    f'{first[key]}')
+    shard_index_list = sorted(
+        manifest['shard_index'] for manifest in manifest_list)
+    missing_shards = sorted(
+        set(range(1, first['n_shards']+1)) - set(shard_index_list))
+    if missing_shards:
+        raise ValueError(
+            f'missing shards {missing_shards} of {first["n_shards"]}')
+    if len(shard_index_list) != len(set(shard_index_list)):
+        raise ValueError(f'duplicate shards in {shard_index_list}')
+    return manifest_list
+
+
+def _read_shard_rows(manifest):
+    """Yield (row index, row dict) of a shard csv and check its length."""
+    n_rows = 0
+    with open(manifest['shard_csv_path'], newline='') as shard_file:
+        for row in csv.DictReader(shard_file):
+            n_rows += 1
+            yield int(row.pop(ROW_INDEX_FIELD)), row
+    if n_rows != manifest['n_rows']:
+        raise ValueError(
+            f'{manifest["shard_csv_path"]} has {n_rows} rows but its '
+            f'manifest lists {manifest["n_rows"]}')
+
+
+def merge_shards(manifest_path_list, target_path=None):
+    """Merge a complete set of shard csvs into one table in row order.
+
+    Shards are read line by line and interleaved by row index so the whole
+    table is never held in memory. Table columns come first, followed by
+    the sample columns in the order the shards share or sorted if they
+    differ, as an unsharded run writes them. Columns missing from a shard
+    are written as ``INVALID_VALUE``.
+
+    Args:
+        manifest_path_list (list): paths to the manifests of every shard
+        target_path (str): path to the merged table, defaults to the
+            ``table_path`` recorded in the manifests
+
+    Returns:
+        path to the merged table
+    """
+    manifest_list = _load_manifests(manifest_path_list)
+    if target_path is None:
+        target_path = manifest_list[0]['table_path']
+
+    sample_column_list = manifest_list[0]['sample_columns']
+    if any(manifest['sample_columns'] != sample_column_list
+           for manifest in manifest_list):
+        sample_column_list = sorted(set(
+            column for manifest in manifest_list
+            for column in manifest['sample_columns']))
+    column_list = manifest_list[0]['table_columns'] + sample_column_list
+
+    with open(target_path, 'w', newline='') as target_file:
+        writer = csv.writer(target_file, lineterminator='\n')
+        writer.writerow(column_list)
+        for _, row in heapq.merge(
+                *[_read_shard_rows(manifest) for manifest in manifest_list],
+                key=lambda index_row: index_row[0]):
+            writer.writerow([
+                row.get(column, INVALID_VALUE) for column in column_list])
+    return target_path
+
+
+def add_arguments(parser):
+    """Add the shard merge options to ``parser``."""
+    parser.add_argument('manifest_path', nargs='+', help='paths to the .manifest.json of every shard')
+    parser.add_argument('--target_path', help='path to merged table, defaults to the table path recorded in the manifests')
+
+
+def run(args):
+    """Merge the shards listed in ``args.manifest_path``."""
+    target_path = merge_shards(args.manifest_path, args.target_path)
+    print(f'merged {len(args.manifest_path)} shards into {target_path}')
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='Work with sharded sample outputs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser(
+        'merge', help='check all shards are complete and merge them into the final table in original row order')
+    add_arguments(merge_parser)
+    merge_parser.set_defaults(run=run)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
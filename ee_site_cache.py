@@ -0,0 +1,67 @@
+"""Persistent SQLite cache of static per-site sample results."""
+import json
+import sqlite3
+
+COORD_DECIMALS = 7
+
+
+def site_key(lon, lat, point_buffer, year):
+    """Return the (lon, lat, buffer, year) key identifying a sample site."""
+    return (
+        round(float(lon), COORD_DECIMALS), round(float(lat), COORD_DECIMALS),
+        float(point_buffer), int(year))
+
+
+class SiteCache(object):
+    """SQLite table of sampled fields keyed by site and sampling config.
+
+    ``config`` is an opaque string describing everything other than the
+    site itself that changes the sampled values (landcover datasets,
+    polygon, scale, reducer) so results from different setups never mix.
+    """
+
+    def __init__(self, cache_path):
+        """Create or open the cache database at ``cache_path``."""
+        self.cache_path = cache_path
+        with sqlite3.connect(self.cache_path) as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS site_fields ('
+                'lon REAL NOT NULL, '
+                'lat REAL NOT NULL, '
+                'point_buffer REAL NOT NULL, '
+                'year INTEGER NOT NULL, '
+                'config TEXT NOT NULL, '
+                'fields TEXT NOT NULL, '
+                'PRIMARY KEY (lon, lat, point_buffer, year, config)'
+                ') WITHOUT ROWID')
+
+    def get_many(self, config, site_key_list):
+        """Look up cached fields for a list of site keys.
+
+        Args:
+            config (str): sampling configuration the fields were made with
+            site_key_list (list): list of keys made by ``site_key``
+
+        Returns:
+            dict mapping the site keys that are cached to a dict of fields
+        """
+        result = {}
+        with sqlite3.connect(self.cache_path) as conn:
+            for key in set(site_key_list):
+                row = conn.execute(
+                    'SELECT fields FROM site_fields WHERE lon=? AND lat=? '
+                    'AND point_buffer=? AND year=? AND config=?',
+                    (*key, config)).fetchone()
+                if row is not None:
+                    result[key] = json.loads(row[0])
+        return result
+
+    def put_many(self, config, fields_by_site_key):
+        """Store a dict of site key to fields dict under ``config``."""
+        with sqlite3.connect(self.cache_path) as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO site_fields '
+                '(lon, lat, point_buffer, year, config, fields) '
+                'VALUES (?, ?, ?, ?, ?, ?)', [
+                    (*key, config, json.dumps(fields))
+                    for key, fields in fields_by_site_key.items()])
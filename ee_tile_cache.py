@@ -0,0 +1,255 @@
+"""On-disk, memory-mapped cache of static GEE raster tiles."""
+import logging
+import math
+import os
+import re
+import threading
+
+import ee_geometry
+import ee_lazy
+
+ee = ee_lazy.lazy_import('ee')
+numpy = ee_lazy.lazy_import('numpy')
+
+LOGGER = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+METERS_PER_DEGREE = ee_geometry.METERS_PER_DEGREE
+DEFAULT_MAX_CACHE_BYTES = 10 * 2**30
+TILE_NODATA = 0
+# names the tile grid in cached file names so tiles fetched on an older
+# grid are never read back as this one
+TILE_GRID_ID = 'rowscaled'
+
+
+def tile_degrees(scale, iy):
+    """Return the pixel and tile sizes in degrees of tile row ``iy``.
+
+    Pixels are ``scale`` m north to south everywhere and ``scale`` m east
+    to west at the center latitude of their tile row, so a pixel covers
+    about ``scale**2`` m2 and pixel counts match a projected grid of the
+    same scale.
+
+    Args:
+        scale (float): pixel size of the tile grid in m
+        iy (int): tile row counted south from 90 degrees north
+
+    Returns:
+        (pixel lon, pixel lat, tile lon, tile lat) sizes in degrees
+    """
+    pixel_lat_deg = scale / METERS_PER_DEGREE
+    tile_lat_deg = pixel_lat_deg * TILE_SIZE
+    row_lat = 90 - (iy + 0.5) * tile_lat_deg
+    # rows at the poles would otherwise wrap around the globe
+    pixel_lon_deg = min(
+        pixel_lat_deg / max(math.cos(math.radians(row_lat)), 1e-6),
+        360 / TILE_SIZE)
+    return (
+        pixel_lon_deg, pixel_lat_deg, pixel_lon_deg * TILE_SIZE, tile_lat_deg)
+
+
+def tile_index_range(lon, lat, radius, scale):
+    """List the tile indexes that intersect a buffered point.
+
+    Args:
+        lon (float): longitude of point center in degrees
+        lat (float): latitude of point center in degrees
+        radius (float): buffer radius in m, pass the circumradius for
+            polygon buffers
+        scale (float): pixel size of the tile grid in m
+
+    Returns:
+        list of (ix, iy) tile indexes in the global EPSG:4326 tile grid
+    """
+    lat_radius = radius / METERS_PER_DEGREE
+    lon_radius = lat_radius / max(math.cos(math.radians(lat)), 1e-6)
+    tile_lat_deg = tile_degrees(scale, 0)[3]
+    min_iy = math.floor((90 - (lat + lat_radius)) / tile_lat_deg)
+    max_iy = math.floor((90 - (lat - lat_radius)) / tile_lat_deg)
+    tile_index_list = []
+    for iy in range(min_iy, max_iy+1):
+        # tiles of each row have their own width
+        tile_lon_deg = tile_degrees(scale, iy)[2]
+        min_ix = math.floor((lon - lon_radius + 180) / tile_lon_deg)
+        max_ix = math.floor((lon + lon_radius + 180) / tile_lon_deg)
+        tile_index_list.extend(
+            (ix, iy) for ix in range(min_ix, max_ix+1))
+    return tile_index_list
+
+
+def fetch_tile(image, band, scale, tile_index, nodata=TILE_NODATA):
+    """Download a single tile of ``image`` from GEE as a numpy array.
+
+    Args:
+        image (ee.Image): image to fetch
+        band (str): band in ``image`` to fetch
+        scale (float): pixel size of the tile grid in m
+        tile_index (tuple): (ix, iy) tile index in the global tile grid
+        nodata (int): value of masked pixels in the tile, must not be a
+            valid value of ``band``
+
+    Returns:
+        TILE_SIZE x TILE_SIZE numpy array of pixel values
+    """
+    ix, iy = tile_index
+    pixel_lon_deg, pixel_lat_deg, tile_lon_deg, tile_lat_deg = tile_degrees(
+        scale, iy)
+    pixels = ee.data.computePixels({
+        'expression': image.select(band).unmask(nodata),
+        'fileFormat': 'NUMPY_NDARRAY',
+        'grid': {
+            'dimensions': {'width': TILE_SIZE, 'height': TILE_SIZE},
+            'affineTransform': {
+                'scaleX': pixel_lon_deg,
+                'shearX': 0,
+                'translateX': -180 + ix * tile_lon_deg,
+                'shearY': 0,
+                'scaleY': -pixel_lat_deg,
+                'translateY': 90 - iy * tile_lat_deg,
+            },
+            'crsCode': 'EPSG:4326',
+        },
+    })
+    return numpy.ascontiguousarray(pixels[band])
+
+
+class TileCache(object):
+    """LRU capped directory of ``.npy`` tiles read back as memory maps.
+
+    Tiles are keyed by asset id, band, year, scale and tile index so that
+    static datasets only ever need to be fetched from GEE once per region.
+    Least recently used tiles are deleted when the cache grows past
+    ``max_bytes``. One cache is shared by every thread of a process.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        """Create or open a tile cache in ``cache_dir``."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # guards the size count and eviction against concurrent puts
+        self._lock = threading.Lock()
+        self._size_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(cache_dir)
+            if entry.name.endswith('.npy'))
+
+    def _tile_path(self, asset_id, band, year, scale, tile_index):
+        """Return the path to the file backing the given tile key."""
+        asset_str = re.sub(r'[^A-Za-z0-9_-]', '_', asset_id)
+        return os.path.join(
+            self.cache_dir,
+            f'{asset_str}-{band}-{year}-{scale:g}m-{TILE_GRID_ID}-'
+            f'{tile_index[0]}_{tile_index[1]}.npy')
+
+    def get(self, asset_id, band, year, scale, tile_index):
+        """Return memory mapped tile or None if not cached."""
+        tile_path = self._tile_path(asset_id, band, year, scale, tile_index)
+        try:
+            tile = numpy.load(tile_path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        # bump modified time so eviction is least recently used, another
+        # thread may have evicted the tile since, the open map stays valid
+        try:
+            os.utime(tile_path)
+        except FileNotFoundError:
+            pass
+        return tile
+
+    def put(self, asset_id, band, year, scale, tile_index, tile):
+        """Store ``tile`` in the cache and evict old tiles if over budget."""
+        tile_path = self._tile_path(asset_id, band, year, scale, tile_index)
+        tmp_path = (
+            f'{tile_path}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as tmp_file:
+            numpy.save(tmp_file, tile)
+        with self._lock:
+            # another thread may have fetched the same tile first
+            if os.path.exists(tile_path):
+                self._size_bytes -= os.path.getsize(tile_path)
+            os.replace(tmp_path, tile_path)
+            self._size_bytes += os.path.getsize(tile_path)
+            if self._size_bytes > self.max_bytes:
+                self._evict()
+
+    def get_or_fetch(
+            self, asset_id, band, year, scale, tile_index, image_fn,
+            nodata=TILE_NODATA):
+        """Return cached tile, fetching ``image_fn()`` from GEE on a miss."""
+        tile = self.get(asset_id, band, year, scale, tile_index)
+        if tile is None:
+            LOGGER.debug(
+                f'tile cache miss {asset_id} {band} {year} {tile_index}')
+            tile = fetch_tile(image_fn(), band, scale, tile_index, nodata)
+            self.put(asset_id, band, year, scale, tile_index, tile)
+        return tile
+
+    def _evict(self):
+        """Delete least recently used tiles until under ``max_bytes``.
+
+        Only called with ``_lock`` held.
+        """
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir)
+             if entry.name.endswith('.npy')),
+            key=lambda entry: entry.stat().st_mtime)
+        self._size_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._size_bytes <= self.max_bytes:
+                break
+            self._size_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+def sample_buffer(
+        tile_cache, asset_id, band, year, scale, lon, lat, radius,
+        image_fn, keep_nodata=False,
+        buffer_shape=ee_geometry.DEFAULT_BUFFER_SHAPE, nodata=TILE_NODATA):
+    """Collect pixel values whose centers are inside a buffered point.
+
+    Args:
+        tile_cache (TileCache): cache to read tiles from
+        asset_id (str): asset id used as the cache key
+        band (str): band to sample
+        year (int): year used as the cache key
+        scale (float): pixel size of the tile grid in m
+        lon (float): longitude of point center in degrees
+        lat (float): latitude of point center in degrees
+        radius (float): buffer radius in m
+        image_fn (callable): returns the ``ee.Image`` to fetch on a cache
+            miss
+        keep_nodata (bool): if True, ``nodata`` pixels are kept so the
+            result has one value per pixel inside the buffer
+        buffer_shape (str): ``circle``, ``square`` or ``polygon:N`` shape
+            of the buffer as built by ``ee_geometry.buffer_coordinates``
+        nodata (int): value of masked pixels in the tiles of ``band``
+
+    Returns:
+        1D numpy array of pixel values inside the buffer, ``nodata``
+        pixels are dropped unless ``keep_nodata``
+    """
+    lon_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+    value_list = []
+    _, circumradius = ee_geometry.buffer_vertices(radius, buffer_shape)
+    for tile_index in tile_index_range(lon, lat, circumradius, scale):
+        tile = tile_cache.get_or_fetch(
+            asset_id, band, year, scale, tile_index, image_fn, nodata)
+        ix, iy = tile_index
+        pixel_lon_deg, pixel_lat_deg, tile_lon_deg, tile_lat_deg = (
+            tile_degrees(scale, iy))
+        pixel_offsets = numpy.arange(TILE_SIZE) + 0.5
+        dx = (
+            -180 + ix * tile_lon_deg + pixel_offsets * pixel_lon_deg -
+            lon) * lon_scale
+        dy = (
+            90 - iy * tile_lat_deg - pixel_offsets * pixel_lat_deg -
+            lat) * METERS_PER_DEGREE
+        inside = ee_geometry.inside_buffer(
+            dx[None, :], dy[:, None], radius, buffer_shape)
+        values = tile[inside]
+        if not keep_nodata:
+            values = values[values != nodata]
+        value_list.append(values)
+    if not value_list:
+        return numpy.empty(0)
+    return numpy.concatenate(value_list)
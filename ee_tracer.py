@@ -1,44 +1,308 @@
-"""EE tracer code."""
+"""Extract per-date time series of a GEE image collection at points."""
+from datetime import datetime
+from datetime import timedelta
+import argparse
+import concurrent.futures
+import json
 import os
+import re
 
-import ee
-import pandas
+import ee_lazy
+import ee_reducers
+import ee_session
+import ee_shard
 
-CSV_PATH = 'cotton_site_info.csv'
+ee = ee_lazy.lazy_import('ee')
+pandas = ee_lazy.lazy_import('pandas')
 
 DATASET = 'LANDSAT/LT05/C01/T1_8DAY_NDVI'
 START_DATE = '1997-01-01'
 END_DATE = '2019-01-01'
 
-HEADER_FIELD = f'{DATASET}_{START_DATE}_{END_DATE}'
+DATE_FIELD = 'date'
+IMAGE_ID_FIELD = 'image-id'
+DATE_FORMAT = '%Y-%m-%d'
+INVALID_VALUE = 'invalid'
 
+# fragments of GEE errors that a smaller request may avoid
+RESPONSE_LIMIT_ERRORS = [
+    'accumulating over',
+    'payload size exceeds',
+    'memory limit exceeded',
+    'computation timed out',
+    ]
 
-def main():
-    """Entry point."""
-    ee.Initialize()
-    table = pandas.read_csv(CSV_PATH)
 
-    print(f'reading points from {CSV_PATH}')
-    pts = ee.FeatureCollection([
+def _date_windows(start_date, end_date, window_days):
+    """Split [start_date, end_date) into windows of ``window_days``.
+
+    Returns:
+        list of (start, end) date strings, the last window may be shorter
+    """
+    window_start = datetime.strptime(start_date, DATE_FORMAT)
+    end = datetime.strptime(end_date, DATE_FORMAT)
+    window_list = []
+    while window_start < end:
+        window_end = min(window_start + timedelta(days=window_days), end)
+        window_list.append((
+            window_start.strftime(DATE_FORMAT),
+            window_end.strftime(DATE_FORMAT)))
+        window_start = window_end
+    return window_list
+
+
+def _reduce_window(
+        dataset, band_list, reducer, scale, window, feature_list):
+    """Reduce every image of a window over points on GEE.
+
+    Each image is reduced with ``reduceRegions`` in a mapped function and
+    the per-image collections are flattened, so one request returns the
+    whole time series of every point in the window. Dates where every band
+    is masked at a point are dropped on the server. A request GEE rejects
+    for its size or run time is retried as two halves of the points.
+
+    Args:
+        dataset (str): GEE image collection id
+        band_list (list): bands to extract
+        reducer (ee.Reducer): reducer with one output per band
+        scale (float): scale to sample the images in meters
+        window (tuple): (start, end) date strings, end is exclusive
+        feature_list (list): ``ee.Feature`` points to sample
+
+    Returns:
+        list of properties dicts, one per point and image
+    """
+    points = ee.FeatureCollection(feature_list)
+    images = ee.ImageCollection(dataset).filterDate(*window).filterBounds(
+        points.geometry()).select(band_list)
+
+    def reduce_image(image):
+        """Sample ``image`` at every point and tag the samples with it."""
+        return image.reduceRegions(**{
+            'collection': points,
+            'reducer': reducer,
+            'scale': scale,
+            }).map(lambda feature: feature.set({
+                DATE_FIELD: image.date().format('YYYY-MM-dd'),
+                IMAGE_ID_FIELD: image.get('system:index')}))
+
+    samples = images.map(reduce_image).flatten().filter(ee.Filter.Or(*[
+        ee.Filter.notNull([band]) for band in band_list]))
+    try:
+        return [
+            feature['properties']
+            for feature in samples.getInfo()['features']]
+    except ee.EEException as e:
+        if len(feature_list) == 1 or not any(
+                limit_error in str(e).lower()
+                for limit_error in RESPONSE_LIMIT_ERRORS):
+            raise
+        print(f'splitting {len(feature_list)} points in {window} after: {e}')
+        half = len(feature_list) // 2
+        return (
+            _reduce_window(
+                dataset, band_list, reducer, scale, window,
+                feature_list[:half]) +
+            _reduce_window(
+                dataset, band_list, reducer, scale, window,
+                feature_list[half:]))
+
+
+def _trace_chunk(
+        dataset, band_list, reducer_id, scale, window, batch_table,
+        lat_field, long_field):
+    """Extract the time series of one window for one batch of points.
+
+    Returns:
+        list of csv lines, one per point and image, sorted by row index
+        and date
+    """
+    ee_session.get_session()
+    reducer = ee_reducers.build_reducer([reducer_id], band_list)
+    feature_list = [
         ee.Feature(
-            ee.Geometry.Point(row['long'], row['lat']),
-            row.to_dict())
-        for index, row in table.dropna().iterrows()])
-
-    img = ee.ImageCollection(DATASET).filterDate(START_DATE, END_DATE)
-    mean_img = img.reduce(ee.Reducer.mean())
-    print('starting google earth engine sample')
-    REDUCER = 'first'
-    samples = mean_img.reduceRegions(**{
-        'collection': pts,
-        'scale': 30,
-        'reducer': REDUCER}).getInfo()
-    with open(f'sampled_{os.path.basename(CSV_PATH)}', 'w') as table_file:
-        table_file.write(','.join(table.columns) + f',{HEADER_FIELD}\n')
-        for sample in samples['features']:
-            table_file.write(','.join([
-                str(sample['properties'][key]) for key in table.columns]) +
-                f",{sample['properties'][REDUCER]}\n")
+            ee.Geometry.Point(row[long_field], row[lat_field]),
+            {ee_shard.ROW_INDEX_FIELD: int(index)})
+        for index, row in batch_table.iterrows()]
+    sample_list = sorted(
+        _reduce_window(
+            dataset, band_list, reducer, scale, window, feature_list),
+        key=lambda sample: (
+            sample[ee_shard.ROW_INDEX_FIELD], sample[DATE_FIELD],
+            sample[IMAGE_ID_FIELD]))
+    line_list = []
+    for sample in sample_list:
+        row = batch_table.loc[sample[ee_shard.ROW_INDEX_FIELD]]
+        line_list.append(','.join(
+            [str(sample[ee_shard.ROW_INDEX_FIELD]), str(row[long_field]),
+             str(row[lat_field]), sample[DATE_FIELD],
+             str(sample[IMAGE_ID_FIELD])] + [
+                INVALID_VALUE if sample.get(band) is None
+                else str(sample[band]) for band in band_list]) + '\n')
+    return line_list
+
+
+class TraceProgress(object):
+    """Record of the (window, batch) chunks already written to a table.
+
+    Each completed chunk is appended to ``<table_path>.progress`` with the
+    table size after its rows were written, so a run that is stopped
+    part way through a chunk is resumed by truncating the table back to the
+    last recorded size and skipping every recorded chunk.
+    """
+
+    def __init__(self, table_path, config):
+        """Open or start the progress of ``table_path`` for ``config``.
+
+        Raises:
+            ValueError if a previous run of ``table_path`` used a different
+            config or the table is shorter than recorded.
+        """
+        self.progress_path = f'{table_path}.progress'
+        self.completed_chunks = set()
+        table_size = 0
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as progress_file:
+                previous_config = json.loads(progress_file.readline())
+                if previous_config != config:
+                    raise ValueError(
+                        f'{self.progress_path} was written with {previous_config}, '
+                        f'delete it and {table_path} to start over with '
+                        f'{config}')
+                for line in progress_file:
+                    window_index, batch_index, table_size = [
+                        int(x) for x in line.split(',')]
+                    self.completed_chunks.add((window_index, batch_index))
+        else:
+            with open(self.progress_path, 'w') as progress_file:
+                progress_file.write(json.dumps(config, sort_keys=True) + '\n')
+        if table_size and (
+                not os.path.exists(table_path) or
+                os.path.getsize(table_path) < table_size):
+            raise ValueError(
+                f'{table_path} is shorter than {self.progress_path} records, '
+                'delete both to start over')
+        self.table_size = table_size
+
+    def complete(self, window_index, batch_index, table_size):
+        """Record that a chunk is written and the table is ``table_size``."""
+        with open(self.progress_path, 'a') as progress_file:
+            progress_file.write(f'{window_index},{batch_index},{table_size}\n')
+            progress_file.flush()
+            os.fsync(progress_file.fileno())
+        self.completed_chunks.add((window_index, batch_index))
+
+
+def add_arguments(parser):
+    """Add the time series extraction options to ``parser``."""
+    parser.add_argument('csv_path', help='path to CSV table of points')
+    parser.add_argument('--dataset', default=DATASET, help=f'GEE image collection to trace, defaults to {DATASET}')
+    parser.add_argument('--bands', nargs='+', help='bands of --dataset to extract, defaults to every band of its first image')
+    parser.add_argument('--start_date', default=START_DATE, help=f'first date to extract as YYYY-MM-DD, defaults to {START_DATE}')
+    parser.add_argument('--end_date', default=END_DATE, help=f'date to stop extracting at as YYYY-MM-DD, not included, defaults to {END_DATE}')
+    parser.add_argument('--window_days', type=int, default=365, help='number of days of images extracted in one request, images in a window times --batch_size points must stay under the 5000 features GEE returns at once, defaults to 365')
+    parser.add_argument('--batch_size', type=int, default=100, help='number of points extracted in one request, defaults to 100')
+    parser.add_argument('--scale', type=float, default=30.0, help='scale to sample images in meters, defaults to 30m')
+    parser.add_argument('--reducer', default='first', help='statistic of the pixels under each point, one of mean, median, mode, min, max, sum, count, stdDev, variance or a percentile like p90, defaults to first pixel')
+    parser.add_argument('--lat_field', default='lat', help='field name in csv_path for latitude, defaults to `lat`')
+    parser.add_argument('--long_field', default='long', help='field name in csv_path for longitude, defaults to `long`')
+    parser.add_argument('--n_workers', type=int, default=4, help='number of windows/batches extracted on GEE at once, defaults to 4')
+    parser.add_argument('--processes', action='store_true', help='extract with --n_workers forked processes rather than threads, so parsing large responses is not limited to one core')
+    parser.add_argument('--authenticate', action='store_true', help='Pass this flag if you need to reauthenticate with GEE')
+
+
+def run(args):
+    """Extract the time series of ``args.dataset`` at ``args.csv_path``."""
+    # first is not one of the shared statistics but is the natural choice
+    # for a single pixel under a point
+    if args.reducer != 'first' and len(
+            ee_reducers.parse_reducers(args.reducer)) != 1:
+        raise ValueError(f'only one --reducer is supported, got {args.reducer}')
+    window_list = _date_windows(
+        args.start_date, args.end_date, args.window_days)
+
+    if args.authenticate:
+        ee.Authenticate()
+    ee_session.get_session()
+    band_list = args.bands
+    if not band_list:
+        band_list = ee.ImageCollection(args.dataset).first().bandNames(
+            ).getInfo()
+
+    print(f'reading points from {args.csv_path}')
+    table = pandas.read_csv(args.csv_path, converters={
+        args.long_field: lambda x: float(x),
+        args.lat_field: lambda x: float(x),
+        })[[args.long_field, args.lat_field]].dropna()
+    batch_list = [
+        table[index:index+args.batch_size]
+        for index in range(0, table.shape[0], args.batch_size)]
+
+    dataset_str = re.sub(r'[^A-Za-z0-9_-]', '_', args.dataset)
+    table_path = f'traced_{dataset_str}_{os.path.basename(args.csv_path)}'
+    progress = TraceProgress(table_path, {
+        'csv_path': os.path.abspath(args.csv_path),
+        'dataset': args.dataset,
+        'bands': band_list,
+        'start_date': args.start_date,
+        'end_date': args.end_date,
+        'window_days': args.window_days,
+        'batch_size': args.batch_size,
+        'scale': args.scale,
+        'reducer': args.reducer,
+        })
+    chunk_list = [
+        (window_index, batch_index)
+        for window_index in range(len(window_list))
+        for batch_index in range(len(batch_list))
+        if (window_index, batch_index) not in progress.completed_chunks]
+    print(
+        f'extracting {len(chunk_list)} of '
+        f'{len(window_list)*len(batch_list)} windows/batches, the rest are '
+        f'already in {table_path}')
+
+    with open(table_path, 'a+') as table_file:
+        # drop any rows of a chunk that was not recorded as complete
+        table_file.truncate(progress.table_size)
+        table_file.seek(progress.table_size)
+        if progress.table_size == 0:
+            table_file.write(','.join(
+                [ee_shard.ROW_INDEX_FIELD, args.long_field, args.lat_field,
+                 DATE_FIELD, IMAGE_ID_FIELD] + band_list) + '\n')
+        # forked workers must not inherit unwritten rows
+        table_file.flush()
+        if args.processes:
+            executor = ee_session.fork_process_pool(args.n_workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.n_workers)
+        with executor:
+            future_to_chunk = {
+                executor.submit(
+                    _trace_chunk, args.dataset, band_list, args.reducer,
+                    args.scale, window_list[window_index],
+                    batch_list[batch_index], args.lat_field,
+                    args.long_field): (window_index, batch_index)
+                for window_index, batch_index in chunk_list}
+            for n_complete, future in enumerate(
+                    concurrent.futures.as_completed(future_to_chunk)):
+                window_index, batch_index = future_to_chunk[future]
+                table_file.writelines(future.result())
+                table_file.flush()
+                os.fsync(table_file.fileno())
+                progress.complete(
+                    window_index, batch_index, table_file.tell())
+                print(
+                    f'{n_complete+1} of {len(chunk_list)} done, window '
+                    f'{window_list[window_index]} batch {batch_index}')
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='Extract the full time series of a GEE image collection at every point of a table, written as one row per point and image.')
+    add_arguments(parser)
+    run(parser.parse_args())
 
 
 if __name__ == '__main__':